@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+"""
+Agent Router — JOYA Toolkit
+Long-running local daemon behind `agent-send`. Keeps DIRECTORY.json parsed
+(reloaded when it changes), pools Mattermost HTTP connections and
+multiplexes SSH connections per host, so a message costs one local socket
+round trip instead of several python3 and curl/ssh process starts.
+
+Usage:
+    # Start (one per host and user):
+    nohup python3 agent-router.py > /tmp/agent-router.log 2>&1 &
+
+    # agent-send uses it automatically when the socket exists:
+    agent-send rex "task complete"
+
+    # Broadcast without the daemon (one process for all targets):
+    python3 agent-router.py broadcast --to rex,bob,kit --msg "standup in 5"
+
+    # Health and stats:
+    curl -s --unix-socket /tmp/joya-agent-router-$UID.sock http://agent-router/health
+
+API (HTTP/1.1 over a Unix socket, so curl is the only client dependency):
+    POST /send    form fields: to, msg, sender, joy_root
+                  200 sent · 404 unknown agent · 422 not routable
+                  409 joy_root mismatch · 502 delivery failed
+                  The body is the text agent-send prints.
+    POST /broadcast  form fields: to ("a,b,c" or "*"), msg, sender, joy_root, workers
+                  Mattermost targets sharing a channel get one post with
+                  several @mentions; SSH targets run concurrently.
+                  200 all delivered · 502 otherwise. JSON body with
+                  per-target status and timings.
+    GET  /health  JSON status and counters
+
+Environment:
+    JOY_ROOT           joy-agents root (auto-detected if not set)
+    AGENT_ROUTER_SOCK  socket path (default /tmp/joya-agent-router-<uid>.sock)
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import json
+import os
+import shlex
+import socket
+import socketserver
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mm_log as log
+
+OPENCLAW_PATH = "export PATH=/opt/homebrew/bin:/usr/local/bin:$PATH"
+SSH_OPTS = ["-o", "BatchMode=yes", "-o", "ConnectTimeout=8", "-o", "StrictHostKeyChecking=accept-new"]
+DEFAULT_WORKERS = 8  # concurrent deliveries per broadcast
+MAX_WORKERS = 64
+
+
+def default_socket():
+    return os.environ.get("AGENT_ROUTER_SOCK", f"/tmp/joya-agent-router-{os.getuid()}.sock")
+
+
+def find_joy_root():
+    """Auto-detect JOY_ROOT from environment or script location."""
+    if os.environ.get("JOY_ROOT"):
+        return os.environ["JOY_ROOT"]
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.normpath(os.path.join(script_dir, "..", "..", ".."))
+
+
+class RouteError(Exception):
+    """A message that cannot be routed; carries the HTTP status and agent-send text."""
+
+    def __init__(self, status, text):
+        super().__init__(text)
+        self.status = status
+        self.text = text
+
+
+# ============================================================
+# Directory (parsed once, reloaded on change)
+# ============================================================
+
+class Directory:
+    def __init__(self, path):
+        self.path = path
+        self.agents = {}
+        self.loads = 0
+        self._sig = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Current agents map; re-reads DIRECTORY.json only if its mtime or size changed."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            raise RouteError(500, f"❌ DIRECTORY.json not found: {self.path}")
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig != self._sig:
+            with self._lock:
+                if sig != self._sig:
+                    with open(self.path) as f:
+                        self.agents = json.load(f).get("agents", {})
+                    self._sig = sig
+                    self.loads += 1
+                    log.info("directory_loaded", path=self.path, agents=len(self.agents))
+        return self.agents
+
+    def route(self, target):
+        """Resolve a target the same way agent-send does (v2 flat and v3 adapters formats)."""
+        agents = self.get()
+        agent = agents.get(target)
+        if not agent:
+            names = "\n".join(f"     - {k}" for k in agents)
+            raise RouteError(404, f"❌ Unknown agent: {target}\n   Available agents:\n{names}")
+
+        adapters = agent.get("adapters", {})
+        notify = "ssh"
+        if "mattermost" in adapters and "ssh" not in adapters:
+            notify = "mattermost"
+        elif agent.get("notify"):
+            notify = agent["notify"]
+
+        ssh = adapters.get("ssh", {})
+        mm = adapters.get("mattermost", agent.get("mattermost", {}))
+        return {
+            "name": target,
+            "notify": notify,
+            "host": ssh.get("host", agent.get("host", agent.get("node", ""))),
+            "session_to": agent.get("sessionTo", agent.get("session_to", "")),
+            "mm_channel": mm.get("channel_id", ""),
+            "mm_token": mm.get("bot_token", ""),
+            "mm_url": mm.get("base_url", ""),
+        }
+
+    def sender_token(self, sender):
+        agent = self.get().get(sender, {})
+        return agent.get("adapters", {}).get("mattermost", {}).get("bot_token", "")
+
+
+# ============================================================
+# Transports
+# ============================================================
+
+class HttpPool:
+    """Keep-alive HTTP(S) connections per Mattermost origin."""
+
+    def __init__(self, per_origin=4, timeout=None):
+        self.per_origin = per_origin
+        self.timeout = timeout  # None: wait for Mattermost as long as the old curl call did
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+        self._ssl_ctx = ssl.create_default_context()
+
+    def _connect(self, scheme, netloc, timeout):
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout, context=self._ssl_ctx)
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+
+    def request(self, base_url, method, path, body=None, headers=None):
+        u = urllib.parse.urlsplit(base_url)
+        key = (u.scheme, u.netloc)
+        full_path = u.path.rstrip("/") + path
+        for attempt in range(2):
+            with self._lock:
+                conn = self._idle[key].pop() if self._idle[key] else None
+            reused = conn is not None
+            conn = conn or self._connect(u.scheme, u.netloc, self.timeout)
+            sent = False
+            try:
+                conn.request(method, full_path, body=body, headers=headers or {})
+                sent = True
+                resp = conn.getresponse()
+            except (BrokenPipeError, ConnectionResetError) as e:
+                # Only a stale idle connection is retried: the send failed, or the
+                # server closed it without a single response byte (RemoteDisconnected).
+                # Timeouts are never retried: POST /posts is not idempotent.
+                conn.close()
+                if reused and attempt == 0 and (not sent or isinstance(e, http.client.RemoteDisconnected)):
+                    continue
+                raise
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+            try:
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    if len(self._idle[key]) < self.per_origin:
+                        self._idle[key].append(conn)
+                    else:
+                        conn.close()
+            return resp.status, data
+
+    def open_connections(self):
+        with self._lock:
+            return sum(len(v) for v in self._idle.values())
+
+
+class SshMux:
+    """Run commands on agent hosts over one multiplexed SSH master per host."""
+
+    def __init__(self, control_dir, persist="10m"):
+        self.control_dir = control_dir
+        self.persist = persist
+        self.local_host = socket.gethostname().split(".")[0]
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+    def run(self, host, command, timeout=120):
+        if host == self.local_host:
+            argv = ["bash", "-c", command]
+        else:
+            argv = ["ssh", *SSH_OPTS,
+                    "-o", "ControlMaster=auto",
+                    "-o", f"ControlPath={self.control_dir}/%C",
+                    "-o", f"ControlPersist={self.persist}",
+                    host, command]
+        return subprocess.run(argv, capture_output=True, text=True, timeout=timeout)
+
+
+# ============================================================
+# Router
+# ============================================================
+
+class Router:
+    def __init__(self, joy_root, control_dir, http_timeout=None):
+        self.joy_root = joy_root
+        self.directory = Directory(os.path.join(joy_root, "my", "shared", "agents", "DIRECTORY.json"))
+        self.http = HttpPool(timeout=http_timeout)
+        self.ssh = SshMux(control_dir)
+        self.started = time.time()
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def send(self, target, msg, sender=""):
+        """Deliver one message. Returns the agent-send output text; raises RouteError."""
+        route = self.directory.route(target)
+        if route["notify"] == "mattermost":
+            return self.send_mattermost(route, msg, sender)
+        if route["host"] in ("manual", "external"):
+            raise RouteError(422, f"Target {target} is manual/external; use handoff packet flow.")
+        return self.send_ssh(route, msg)
+
+    def send_mattermost(self, route, msg, sender):
+        target = route["name"]
+        token = self._mm_token(route, sender)
+        post_id = self._mm_post(route["mm_url"], route["mm_channel"], token, f"@{target} {msg}")
+        return json.dumps({"text": f"[mattermost] Message sent to @{target} (post: {post_id})"},
+                          ensure_ascii=False)
+
+    def _mm_token(self, route, sender):
+        target = route["name"]
+        if not route["mm_url"] or not route["mm_channel"]:
+            raise RouteError(422, f"❌ Mattermost config incomplete for {target}. "
+                                  "Check DIRECTORY.json adapters.mattermost.")
+        # Use the sender's token if available, so the message shows as from the sender
+        token = route["mm_token"]
+        if sender and sender != target:
+            token = self.directory.sender_token(sender) or token
+        if not token:
+            raise RouteError(422, "❌ No Mattermost token available. Set AGENT_NAME or check DIRECTORY.json.")
+        return token
+
+    def _mm_post(self, mm_url, channel_id, token, message):
+        body = json.dumps({"channel_id": channel_id, "message": message})
+        status, data = self.http.request(
+            mm_url, "POST", "/api/v4/posts", body=body.encode(),
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        )
+        try:
+            post_id = json.loads(data).get("id", "")
+        except ValueError:
+            post_id = ""
+        if not post_id:
+            raise RouteError(502, data.decode("utf-8", "replace"))
+        return post_id
+
+    def send_ssh(self, route, msg):
+        to = route["session_to"]
+        # session_to format: "agent:<agentId>:main" — extract agentId for --agent flag
+        parts = to.split(":")
+        if to.startswith("agent:") and len(parts) >= 3:
+            select = f"--agent {shlex.quote(parts[1])}"
+        else:
+            select = f"--session-id {shlex.quote(to)}"
+        command = f"{OPENCLAW_PATH}; openclaw agent {select} --message {shlex.quote(msg)} --timeout 60 --json"
+        result = self.ssh.run(route["host"], command)
+        if result.returncode != 0:
+            raise RouteError(502, (result.stdout + result.stderr).rstrip())
+        return result.stdout.rstrip()
+
+    def broadcast(self, targets, msg, sender="", workers=DEFAULT_WORKERS):
+        """
+        Deliver one message to several agents. Targets are resolved once;
+        Mattermost targets sharing a channel get a single post with all their
+        @mentions; SSH targets run concurrently on up to `workers` threads.
+        Returns (all_delivered, result dict).
+        """
+        t0 = time.monotonic()
+        agents = self.directory.get()
+        if targets == ["*"]:
+            targets = [name for name in agents if name != sender]
+        targets = list(dict.fromkeys(t for t in targets if t))
+
+        results = {}
+        groups = collections.OrderedDict()  # (mm_url, channel, token) → [route]
+        ssh_routes = []
+        for name in targets:
+            try:
+                route = self.directory.route(name)
+                if route["notify"] == "mattermost":
+                    token = self._mm_token(route, sender)
+                    groups.setdefault((route["mm_url"], route["mm_channel"], token), []).append(route)
+                elif route["host"] in ("manual", "external"):
+                    results[name] = {"agent": name, "route": "manual", "status": "skipped",
+                                     "error": f"Target {name} is manual/external; use handoff packet flow."}
+                else:
+                    ssh_routes.append(route)
+            except RouteError as e:
+                results[name] = {"agent": name, "status": "unknown" if e.status == 404 else "failed",
+                                 "error": e.text.splitlines()[0]}
+
+        def mm_job(key, routes):
+            t = time.monotonic()
+            mentions = " ".join(f"@{r['name']}" for r in routes)
+            try:
+                post_id = self._mm_post(key[0], key[1], key[2], f"{mentions} {msg}")
+                row = {"status": "sent", "post_id": post_id}
+            except Exception as e:
+                row = {"status": "failed", "error": getattr(e, "text", str(e))}
+            ms = int((time.monotonic() - t) * 1000)
+            for r in routes:
+                results[r["name"]] = {"agent": r["name"], "route": "mattermost", "ms": ms,
+                                      "batched": len(routes), **row}
+
+        def ssh_job(route):
+            t = time.monotonic()
+            try:
+                row = {"status": "sent", "output": self.send_ssh(route, msg)}
+            except Exception as e:
+                row = {"status": "failed", "error": getattr(e, "text", str(e))}
+            results[route["name"]] = {"agent": route["name"], "route": "ssh", "host": route["host"],
+                                      "ms": int((time.monotonic() - t) * 1000), **row}
+
+        jobs = [(mm_job, (key, routes)) for key, routes in groups.items()]
+        jobs += [(ssh_job, (route,)) for route in ssh_routes]
+        if jobs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+                for future in [pool.submit(fn, *args) for fn, args in jobs]:
+                    future.result()
+
+        rows = [results[name] for name in targets]
+        sent = sum(r["status"] == "sent" for r in rows)
+        skipped = sum(r["status"] == "skipped" for r in rows)
+        ms = int((time.monotonic() - t0) * 1000)
+        summary = (f"[broadcast] {sent}/{len(rows)} delivered "
+                   f"({len(groups)} mattermost posts, {len(ssh_routes)} ssh) in {ms} ms")
+        # Manual/external agents are reported but do not fail the broadcast.
+        return sent + skipped == len(rows), {"text": summary, "ms": ms, "results": rows}
+
+    def health(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "joy_root": self.joy_root,
+            "uptime_s": int(time.time() - self.started),
+            "agents": len(self.directory.agents),
+            "directory_loads": self.directory.loads,
+            "http_idle_connections": self.http.open_connections(),
+            "stats": stats,
+        }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "agent-router"
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, fmt, *args):
+        pass  # requests are logged as structured events below
+
+    def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, json.dumps(self.server.router.health()), "application/json")
+        else:
+            self._reply(404, "not found")
+
+    def do_POST(self):
+        router = self.server.router
+        length = int(self.headers.get("Content-Length") or 0)
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"), keep_blank_values=True)
+        field = lambda name: form.get(name, [""])[0]
+
+        if self.path not in ("/send", "/broadcast"):
+            return self._reply(404, "not found")
+        joy_root = field("joy_root")
+        if joy_root and os.path.realpath(joy_root) != os.path.realpath(router.joy_root):
+            return self._reply(409, f"agent-router serves {router.joy_root}")
+        if self.path == "/broadcast":
+            return self._broadcast(router, field)
+
+        t = time.monotonic()
+        target = field("to")
+        try:
+            text = router.send(target, field("msg"), field("sender"))
+            status = 200
+        except RouteError as e:
+            text, status = e.text, e.status
+        except Exception as e:
+            text, status = f"❌ agent-router error: {e}", 502
+        ms = int((time.monotonic() - t) * 1000)
+        router.count(f"send_{status}")
+        log.info("send", to=target, sender=field("sender"), status=status, ms=ms)
+        self._reply(status, text)
+
+    def _broadcast(self, router, field):
+        targets = field("to").split(",")
+        workers = parse_workers(field("workers"))
+        try:
+            ok, result = router.broadcast(targets, field("msg"), field("sender"), workers=workers)
+            status = 200 if ok else 502
+        except RouteError as e:
+            result, status = {"text": e.text, "results": []}, e.status
+        router.count(f"broadcast_{status}")
+        router.count("broadcast_targets", len(result["results"]))
+        log.info("broadcast", to=field("to"), sender=field("sender"), status=status, ms=result.get("ms", 0))
+        self._reply(status, json.dumps(result, ensure_ascii=False), "application/json")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(router, sock_path):
+    if os.path.exists(sock_path):
+        # Refuse to steal the socket from a running router; clean up a stale one.
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(sock_path)
+            log.error("already_running", socket=sock_path)
+            sys.exit(1)
+        except OSError:
+            os.unlink(sock_path)
+        finally:
+            probe.close()
+
+    old_umask = os.umask(0o177)  # socket readable/writable by this user only
+    try:
+        server = _Server(sock_path, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.router = router
+    log.info("startup", pid=os.getpid(), socket=sock_path, joy_root=router.joy_root)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(sock_path)
+
+
+def parse_workers(value):
+    """Broadcast concurrency from a flag, form field or env var; invalid values fall back to the default."""
+    try:
+        return min(max(int(value), 1), MAX_WORKERS)
+    except (TypeError, ValueError):
+        return DEFAULT_WORKERS
+
+
+def broadcast_once(router, args):
+    """One-shot broadcast without the daemon; prints the aggregated JSON result."""
+    ok, result = router.broadcast(args.to.split(","), args.msg, args.sender, workers=args.workers)
+    print(json.dumps(result, ensure_ascii=False))
+    sys.exit(0 if ok else 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JOYA — Agent Router daemon")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "broadcast"],
+                        help="serve (default) or a one-shot broadcast")
+    parser.add_argument("--socket", default=default_socket(),
+                        help="Unix socket path (or set AGENT_ROUTER_SOCK env)")
+    parser.add_argument("--joy-root", default="", help="JOYA root (or set JOY_ROOT env)")
+    parser.add_argument("--ssh-control-dir", default=os.path.expanduser("~/.ssh/joya-mux"),
+                        help="Directory for SSH ControlMaster sockets (default: ~/.ssh/joya-mux)")
+    parser.add_argument("--to", default="", help="broadcast: comma-separated agents, or * for everyone")
+    parser.add_argument("--msg", default="", help="broadcast: message text")
+    parser.add_argument("--sender", default=os.environ.get("AGENT_NAME", ""),
+                        help="broadcast: sending agent (or set AGENT_NAME env)")
+    parser.add_argument("--workers", type=parse_workers, default=os.environ.get("AGENT_SEND_WORKERS", ""),
+                        help=f"Concurrent deliveries per broadcast (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--http-timeout", type=float, default=0,
+                        help="Mattermost request timeout in seconds (default: 0 = wait, like curl)")
+    log.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.command == "broadcast":
+        # Keep stdout for the JSON result.
+        log.setup("agent-router", level="warning", stream=sys.stderr)
+    else:
+        log.setup_from_args("agent-router", args)
+    joy_root = os.path.abspath(args.joy_root or find_joy_root())
+    router = Router(joy_root, args.ssh_control_dir, http_timeout=args.http_timeout or None)
+    try:
+        router.directory.get()
+    except RouteError as e:
+        log.error("config_error", reason=e.text)
+        sys.exit(1)
+    if args.command == "broadcast":
+        broadcast_once(router, args)
+    serve(router, args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""
+Trace Replay Driver — JOYA Toolkit
+Feeds a session recorded with `--trace` back into the listener core
+(mm_listener.py), with the websocket, REST and backend calls stubbed from the
+trace, and reports what the listener decided and how fast it got there.
+
+Usage:
+    # Max speed, with the backend the trace was recorded with:
+    python3 mm-replay.py /tmp/rex.trace.gz
+
+    # Real time / 10x, with the claude backend's prompts:
+    python3 mm-replay.py /tmp/rex.trace.gz --speed 1
+    python3 mm-replay.py /tmp/rex.trace.gz --speed 10 --backend claude
+
+    # Load test: the in-process stub backend answers instead of the recording
+    python3 mm-replay.py /tmp/rex.trace.gz --backend stub --stub-latency-ms 2000
+
+    # What would the reply cache have saved on this session?
+    python3 mm-replay.py /tmp/rex.trace.gz --reply-cache-ttl 600 --reply-cache-scope all
+
+    # Compare two versions of the listener on the same trace:
+    python3 mm-replay.py /tmp/rex.trace.gz --report before.json    # old tree
+    python3 mm-replay.py /tmp/rex.trace.gz --report after.json     # new tree
+    diff <(jq -c '.events[]' before.json) <(jq -c '.events[]' after.json)
+
+The listener runs on a virtual clock that follows the trace. A stubbed
+backend call takes its recorded duration in trace time, whatever the replay
+speed, so rate limits and cooldowns see production timing. --speed only
+controls how much real time passes between trace steps (0 = as fast as
+possible).
+
+No network access, websockets package or backend CLI is needed.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import importlib
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mm_backends
+import mm_log as log
+import mm_replies
+import mm_trace
+
+_SETTLE_TIMEOUT_S = 60
+
+
+# ============================================================
+# Trace
+# ============================================================
+
+class Trace:
+    """A recorded session, indexed for the stubs."""
+
+    def __init__(self, path):
+        self.header = {}
+        self.frames = []                                          # [(t, raw)]
+        self.users = {}                                           # user_id → username
+        self.files = {}                                           # file_id → [path, name, mime]
+        self.threads = {}                                         # root_id → /posts/{id}/thread response
+        self.backend = collections.defaultdict(collections.deque)  # prompt key → [(ms, reply)]
+        self.backend_by_id = {}                                   # post id → (ms, reply)
+        self.post_ms = {}                                         # post id → reply post duration
+        self.decisions = {}                                       # post id → accepted
+        self.replied = set()                                      # post ids that got a reply
+
+        for r in mm_trace.read(path):
+            kind = r["k"]
+            if kind == "hdr":
+                self.header = r
+            elif kind == "ws":
+                self.frames.append((r["t"], r["raw"]))
+            elif kind == "decision" and r.get("id"):
+                self.decisions[r["id"]] = r["accept"]
+            elif kind == "rest":
+                rest = {"user": self.users, "file": self.files, "thread": self.threads}.get(r["op"])
+                if rest is not None:
+                    rest[r["key"]] = r["val"]
+            elif kind == "backend":
+                self.backend[r["key"]].append((r["ms"], r["out"]))
+                if r.get("id"):
+                    self.backend_by_id[r["id"]] = (r["ms"], r["out"])
+            elif kind == "post" and r.get("id"):
+                self.replied.add(r["id"])
+                self.post_ms[r["id"]] = r.get("ms", 0)
+
+
+# ============================================================
+# Virtual clock
+# ============================================================
+
+class Scheduler:
+    """
+    Trace-time clock shared by the listener and the replay driver.
+
+    Every executor job counts as active until it finishes or blocks in a
+    stubbed call. The driver only moves the clock when nothing is active and
+    no queued job could start, then wakes blocked jobs in due-time order.
+    Jobs queued behind `workers` busy (or blocked) threads wait for the
+    clock, as they would wait for a free worker in production.
+    """
+
+    def __init__(self, base, workers):
+        self.base = base
+        self.now = 0.0
+        self.workers = workers
+        self._cv = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._running = 0  # started and not finished, blocked ones included
+        self._waiting = []  # heap of (due, seq, released_flag)
+        self._seq = itertools.count()
+        self._local = threading.local()
+
+    def time(self):
+        return self.base + self.now
+
+    def job_queued(self):
+        with self._cv:
+            self._queued += 1
+
+    def job_started(self):
+        with self._cv:
+            self._queued -= 1
+            self._running += 1
+            self._active += 1
+            self._cv.notify_all()
+
+    def job_finished(self):
+        with self._cv:
+            self._running -= 1
+            self._active -= 1
+            self._cv.notify_all()
+
+    def _idle(self):
+        return self._active == 0 and (self._queued == 0 or self._running >= self.workers)
+
+    def sleep_until(self, due):
+        """Block the calling job until the clock reaches `due` (trace seconds)."""
+        flag = [False]
+        t = time.perf_counter()
+        with self._cv:
+            heapq.heappush(self._waiting, (due, next(self._seq), flag))
+            self._active -= 1
+            self._cv.notify_all()
+            self._cv.wait_for(lambda: flag[0])
+        self._local.blocked = getattr(self._local, "blocked", 0.0) + time.perf_counter() - t
+
+    def take_blocked(self):
+        blocked, self._local.blocked = getattr(self._local, "blocked", 0.0), 0.0
+        return blocked
+
+    def settle(self):
+        with self._cv:
+            if not self._cv.wait_for(self._idle, timeout=_SETTLE_TIMEOUT_S):
+                raise RuntimeError("listener jobs did not settle; an unstubbed call may be blocking")
+
+    def next_due(self):
+        with self._cv:
+            return self._waiting[0][0] if self._waiting else None
+
+    def release_next(self):
+        with self._cv:
+            due, _, flag = heapq.heappop(self._waiting)
+            self.now = max(self.now, due)
+            flag[0] = True
+            self._active += 1
+            self._cv.notify_all()
+        self.settle()
+
+
+class _VirtualTime(types.ModuleType):
+    """`time` module stand-in whose time() follows the scheduler."""
+
+    def __init__(self, sched):
+        super().__init__("time")
+        self._sched = sched
+
+    def time(self):
+        return self._sched.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# ============================================================
+# Fake websocket
+# ============================================================
+
+class _FakeSocket:
+    def __init__(self):
+        self.frames = asyncio.Queue()
+        self.waiting = asyncio.Event()  # set whenever the listener asks for the next frame
+
+    async def send(self, data):
+        pass
+
+    async def recv(self):
+        return json.dumps({"status": "OK", "seq_reply": 1})
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.waiting.set()
+        return await self.frames.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# ============================================================
+# Replay
+# ============================================================
+
+def load_listener():
+    # The listener exits at import time without websockets; it is faked below anyway.
+    sys.modules.setdefault("websockets", types.ModuleType("websockets"))
+    return importlib.import_module("mm_listener")
+
+
+def recorded_backend(header):
+    """Backend a trace was recorded with (older traces only name the listener script)."""
+    if header.get("backend"):
+        return header["backend"]
+    return "claude" if "claude" in header.get("listener", "") else "openclaw"
+
+
+class Replay:
+    def __init__(self, module, trace, speed, backend, replies=None):
+        self.module = module
+        self.trace = trace
+        self.speed = speed
+        self.backend = backend
+        self.replies = replies
+        # Same size as asyncio's default executor in the listener.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4))
+        self.sched = Scheduler(base=time.time(), workers=self.executor._max_workers)
+        self.events = collections.OrderedDict()  # post id → result row
+        self.current_event = ""
+        self.backend_misses = 0
+        self.dispatch_us = []
+        self.overhead_ms = []
+        self._job_event = threading.local()
+        self._real_start = 0.0
+
+    # --------------------------------------------------------
+    # Stubs
+    # --------------------------------------------------------
+
+    def install(self):
+        m, trace, sched = self.module, self.trace, self.sched
+        cfg = dict(trace.header.get("cfg", {}))
+        cfg.setdefault("my_bot_token", "replay")
+        cfg.setdefault("admin_token", "replay")
+        m.CFG = cfg
+        m.BACKEND = self.backend
+        m.IMAGES = None
+        m.REPLIES = self.replies
+        if self.replies is not None:
+            self.replies.clock = sched.time
+        m.time = _VirtualTime(sched)
+
+        respond = m.should_i_respond
+
+        def should_i_respond(*args, **kwargs):
+            accepted = respond(*args, **kwargs)
+            row = self.events.get(self.current_event)
+            if row is not None:
+                row["accept"] = bool(accepted)
+            return accepted
+
+        def get_username(user_id):
+            return trace.users.get(user_id, "unknown")
+
+        def sleep(seconds):
+            sched.sleep_until(sched.now + seconds)
+
+        def download_file(file_id):
+            val = trace.files.get(file_id)
+            return tuple(val) if val else None
+
+        def fetch_thread(root_id):
+            return trace.threads.get(root_id)
+
+        def backend(message, *args, **kwargs):
+            # Prompts differ between listeners; fall back to the post being handled.
+            recorded = trace.backend.get(mm_trace.prompt_key(message))
+            event_id = getattr(self._job_event, "id", "")
+            if recorded:
+                ms, out = recorded.popleft()
+            elif event_id in trace.backend_by_id:
+                ms, out = trace.backend_by_id[event_id]
+            else:
+                self.backend_misses += 1
+                ms, out = 0, None
+            sched.sleep_until(sched.now + ms / 1000)
+            return out
+
+        def mm_post(channel_id, message, *args, **kwargs):
+            event_id = getattr(self._job_event, "id", "")
+            sched.sleep_until(sched.now + trace.post_ms.get(event_id, 0) / 1000)
+            row = self.events.get(event_id)
+            if row is not None:
+                row["replied"] = True
+                row["reply_latency_ms"] = int((sched.now - row["t"]) * 1000)
+            return f"{event_id}-reply"
+
+        m.should_i_respond = should_i_respond
+        m.get_username = get_username
+        m.download_file = download_file
+        m.fetch_thread = fetch_thread
+        m.mm_post = mm_post
+        if isinstance(self.backend, mm_backends.StubBackend):
+            # The stub answers for real, on the virtual clock.
+            self.backend.sleep = sleep
+        else:
+            for name in mm_trace.BACKEND_FUNCS:
+                setattr(m, name, backend)
+        if self.backend.supports(mm_backends.IMAGES):
+            m.IMAGES = types.SimpleNamespace(fetch=download_file)
+
+    def _patch_executor(self, loop):
+        loop.set_default_executor(self.executor)
+        submit = loop.run_in_executor
+
+        def run_in_executor(executor, fn, *args):
+            self.sched.job_queued()
+            event_id = self.current_event
+
+            def job():
+                self.sched.job_started()
+                self._job_event.id = event_id
+                t = time.perf_counter()
+                try:
+                    return fn(*args)
+                finally:
+                    real = time.perf_counter() - t - self.sched.take_blocked()
+                    self.overhead_ms.append(real * 1000)
+                    self.sched.job_finished()
+            return submit(executor, job)
+
+        loop.run_in_executor = run_in_executor
+
+    # --------------------------------------------------------
+    # Driver
+    # --------------------------------------------------------
+
+    async def _pace(self, t):
+        if self.speed:
+            delay = self._real_start + t / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _advance(self, t):
+        """Run blocked jobs due before trace time `t` (None = all), then move the clock to `t`."""
+        while True:
+            self.sched.settle()
+            due = self.sched.next_due()
+            if due is None or (t is not None and due > t):
+                break
+            await self._pace(due)
+            self.sched.release_next()
+        if t is not None:
+            await self._pace(t)
+            self.sched.now = max(self.sched.now, t)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._patch_executor(loop)
+        sock = _FakeSocket()
+        self.module.websockets = types.SimpleNamespace(connect=lambda *a, **kw: sock)
+
+        listener = asyncio.ensure_future(self.module.listen())
+        await sock.waiting.wait()
+        self._real_start = time.perf_counter()
+
+        for t, raw in self.trace.frames:
+            await self._advance(t)
+            event_id = mm_trace.posted_id(raw)
+            if event_id:
+                self.current_event = event_id
+                self.events[event_id] = {
+                    "id": event_id, "t": t, "accept": None, "replied": False,
+                    "recorded_accept": self.trace.decisions.get(event_id),
+                    "recorded_replied": event_id in self.trace.replied,
+                }
+            sock.waiting.clear()
+            t0 = time.perf_counter()
+            sock.frames.put_nowait(raw)
+            await sock.waiting.wait()
+            self.dispatch_us.append((time.perf_counter() - t0) * 1e6)
+
+        await self._advance(None)
+        listener.cancel()
+
+    # --------------------------------------------------------
+    # Report
+    # --------------------------------------------------------
+
+    def report(self, wall_s):
+        rows = list(self.events.values())
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        rss_div = 1024 * 1024 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB on Linux
+        mismatches = [r["id"] for r in rows
+                      if r["recorded_accept"] is not None and r["accept"] != r["recorded_accept"]]
+        summary = {
+            "backend": self.backend.name,
+            "recorded_with": recorded_backend(self.trace.header),
+            "speed": self.speed or "max",
+            "frames": len(self.trace.frames),
+            "trace_span_s": round(self.trace.frames[-1][0], 3) if self.trace.frames else 0,
+            "posted": len(rows),
+            "filtered": sum(r["accept"] is None for r in rows),
+            "accepted": sum(r["accept"] is True for r in rows),
+            "suppressed": sum(r["accept"] is False for r in rows),
+            "replied": sum(r["replied"] for r in rows),
+            "decision_mismatches": len(mismatches),
+            "reply_mismatches": sum(r["replied"] != r["recorded_replied"] for r in rows),
+            "backend_misses": self.backend_misses,
+            "reply_cache": self.replies.stats() if self.replies is not None else None,
+            "reply_latency_ms": _percentiles([r["reply_latency_ms"] for r in rows if r["replied"]]),
+            "dispatch_us": _percentiles(self.dispatch_us),
+            "handler_overhead_ms": _percentiles(self.overhead_ms),
+            "wall_s": round(wall_s, 3),
+            "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+            "max_rss_mb": round(usage.ru_maxrss / rss_div, 1),
+        }
+        return {"summary": summary, "mismatched_ids": mismatches, "events": rows}
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"p50": round(pick(0.5), 2), "p95": round(pick(0.95), 2), "max": round(values[-1], 2)}
+
+
+def _speed(value):
+    return 0.0 if value == "max" else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JOYA — Replay a listener trace")
+    parser.add_argument("trace", help="Trace file written with --trace")
+    parser.add_argument("--backend", choices=sorted(mm_backends.BACKENDS), default="",
+                        help="Backend whose prompts are replayed (default: the recorded one); "
+                             "stub answers in-process instead of using recorded replies")
+    parser.add_argument("--stub-latency-ms", type=int, default=50,
+                        help="stub backend: base reply latency in trace time (default: 50)")
+    parser.add_argument("--stub-jitter-ms", type=int, default=0,
+                        help="stub backend: extra latency derived from the prompt hash (default: 0)")
+    parser.add_argument("--stub-silent-ratio", type=float, default=0.0,
+                        help="stub backend: share of prompts answered with silence (default: 0)")
+    mm_replies.add_arguments(parser)
+    parser.add_argument("--speed", type=_speed, default=0.0,
+                        help="1 = real time, N = N times faster, max (default) = no waiting")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for the listener's probabilistic gates (default: 0)")
+    parser.add_argument("--report", default="", help="Also write the full per-event report here")
+    parser.add_argument("--log-file", default=os.devnull,
+                        help="Where the listener's own JSON logs go (default: discarded)")
+    args = parser.parse_args()
+
+    trace = Trace(args.trace)
+    agent_name = trace.header.get("cfg", {}).get("agent_name", "replay")
+    log.setup(agent_name, path=args.log_file)
+    random.seed(args.seed)
+
+    args.backend = args.backend or recorded_backend(trace.header)
+    args.backend_timeout = 0
+    joy_root = os.environ.get("JOY_ROOT", "")
+    backend = mm_backends.from_args(agent_name, joy_root, args)
+    replies = mm_replies.from_args(agent_name, joy_root, args)
+
+    replay = Replay(load_listener(), trace, args.speed, backend, replies)
+    replay.install()
+
+    t0 = time.perf_counter()
+    asyncio.run(replay.run())
+    result = replay.report(time.perf_counter() - t0)
+
+    print(json.dumps(result["summary"], indent=2, ensure_ascii=False))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+Agent backends for the Mattermost listener — JOYA Toolkit
+
+A backend turns an accepted chat message into a reply. The listener core
+(mm_listener.py) owns everything else: decoding, filtering, scheduling,
+attachments, thread history and posting.
+
+    openclaw  `openclaw agent --session-id mm-<agent>` (OpenClaw agents)
+    claude    `claude -p` with IDENTITY.md / MEMORY.md in the prompt
+    stub      in-process and deterministic, for load tests and replays
+
+Each backend declares its capabilities and the core adapts to them:
+
+    images     attachments are downloaded and handed to the backend
+    sessions   the backend keeps conversation state between calls
+    streaming  the backend can produce partial replies (none do yet)
+    cancel     an in-flight call can be aborted; the core cancels it
+               when the triggering post is deleted
+
+To add a backend, subclass Backend, implement prompt() and call(), and
+register it in BACKENDS.
+"""
+
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+import mm_log as log
+
+IMAGES = "images"
+SESSIONS = "sessions"
+STREAMING = "streaming"
+CANCEL = "cancel"
+
+_CLI_PATH = f"/opt/homebrew/bin:/usr/local/bin:{os.environ.get('PATH', '')}"
+
+
+class Backend:
+    """Base class. Subclasses set `name` and `capabilities`."""
+
+    name = ""
+    capabilities = frozenset()
+
+    def __init__(self, agent_name, joy_root=""):
+        self.agent_name = agent_name
+        self.joy_root = joy_root
+        self._procs = {}  # event_id → running subprocess
+        self._lock = threading.Lock()
+
+    def supports(self, capability):
+        return capability in self.capabilities
+
+    def prompt(self, channel_name, username, message, history="", images=()):
+        """Build the prompt for one message. `history` is rendered thread context."""
+        raise NotImplementedError
+
+    def call(self, prompt, images=(), event_id=""):
+        """Return the reply text, or None to stay silent."""
+        raise NotImplementedError
+
+    def clean(self, reply):
+        """Post-process a reply before it is posted."""
+        return reply
+
+    def cancel(self, event_id):
+        """Abort the call made for `event_id`. Returns True if one was running."""
+        with self._lock:
+            proc = self._procs.get(event_id)
+        if proc is None or proc.poll() is not None:
+            return False
+        _kill(proc)
+        return True
+
+    def _run(self, cmd, timeout, env, event_id=""):
+        """Run a CLI and return its stdout. Cancellable by event id."""
+        # Own process group, so cancelling also stops the CLI's children.
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env,
+                                start_new_session=True)
+        with self._lock:
+            self._procs[event_id] = proc
+        try:
+            out, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill(proc)
+            proc.communicate()
+            raise
+        finally:
+            with self._lock:
+                if self._procs.get(event_id) is proc:
+                    del self._procs[event_id]
+        return out.strip()
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        proc.kill()
+
+
+# ============================================================
+# OpenClaw
+# ============================================================
+
+class OpenClawBackend(Backend):
+    name = "openclaw"
+    capabilities = frozenset({IMAGES, SESSIONS, CANCEL})
+
+    def __init__(self, agent_name, joy_root="", timeout=180):
+        super().__init__(agent_name, joy_root)
+        self.timeout = timeout
+
+    def prompt(self, channel_name, username, message, history="", images=()):
+        context = f"[Mattermost #{channel_name} 群聊] {username} 说: {message}"
+        if history:
+            context = (f"[Mattermost #{channel_name} 群聊 · 话题串] 此前的消息：\n{history}\n\n"
+                       f"{username} 在话题串中说: {message}")
+        if images:
+            context += f"\n（附带 {len(images)} 张图片）"
+        context += "\n（这是工作群聊，像正常同事一样交流。有话说就说，没必要回就回 NO_REPLY。不要每条都回，避免刷屏。）"
+        return context
+
+    def call(self, prompt, images=(), event_id=""):
+        message = prompt
+        if images:
+            message += "\n\n📷 附件图片（请用 image tool 查看）："
+            for path, name, _ in images:
+                message += f"\n- {name}: {path}"
+        try:
+            output = self._run(
+                ["openclaw", "agent", "--session-id", f"mm-{self.agent_name}",
+                 "--message", message, "--timeout", "120", "--json"],
+                timeout=self.timeout, env={**os.environ, "PATH": _CLI_PATH}, event_id=event_id,
+            )
+        except subprocess.TimeoutExpired:
+            log.warning("backend_timeout", backend=self.name, timeout_s=self.timeout)
+            return None
+        except Exception as e:
+            log.error("backend_error", backend=self.name, error=str(e))
+            return None
+        return self._parse(output)
+
+    @staticmethod
+    def _parse(output):
+        if not output:
+            return None
+        try:
+            data = json.loads(output)
+            payloads = data.get("result", {}).get("payloads", [])
+            if payloads:
+                text = payloads[0].get("text", "")
+                return text if text and "NO_REPLY" not in text else None
+            return None
+        except json.JSONDecodeError:
+            pass
+        if '"text"' in output:
+            for line in output.split('\n'):
+                if '"text"' in line:
+                    m = re.search(r'"text"\s*:\s*"(.*)"', line)
+                    if m:
+                        text = m.group(1).replace('\\n', '\n').replace('\\"', '"')
+                        return text if "NO_REPLY" not in text else None
+        if output.startswith('{'):
+            return None
+        return output
+
+    def clean(self, reply):
+        return re.sub(r'^\[来自\w+\]\s*', '', reply)
+
+
+# ============================================================
+# Claude Code
+# ============================================================
+
+class ClaudeBackend(Backend):
+    name = "claude"
+    capabilities = frozenset({IMAGES, CANCEL})
+
+    def __init__(self, agent_name, joy_root="", timeout=120):
+        super().__init__(agent_name, joy_root)
+        self.timeout = timeout
+        self.agent_dir = os.path.join(joy_root, "my", "agents", agent_name)
+
+    def prompt(self, channel_name, username, message, history="", images=()):
+        context = f"[Mattermost #{channel_name}] {username}: {message}"
+        if history:
+            context = (f"[Mattermost #{channel_name}, thread] Earlier in this thread:\n{history}\n\n"
+                       f"{username} replied in the thread: {message}")
+        if images:
+            context += f"\n({len(images)} image(s) attached)"
+        return context
+
+    def _read(self, filename):
+        path = os.path.join(self.agent_dir, filename)
+        if not os.path.isfile(path):
+            return ""
+        with open(path) as f:
+            return f.read()
+
+    def call(self, prompt, images=(), event_id=""):
+        """Call claude -p with the message, return the response text."""
+        agent = self.agent_name.upper()
+        message = prompt
+        if images:
+            message += "\n\nAttached images (open them with the Read tool):"
+            for path, name, _ in images:
+                message += f"\n- {name}: {path}"
+
+        full_prompt = f"""You are **{agent}**. You must reply AS {agent} and ONLY as {agent}.
+
+CRITICAL: You are NOT the person who sent the message below. You are {agent} responding TO them.
+Do NOT impersonate, mimic, or roleplay as the sender. Do NOT say "我是 [sender name]".
+
+Your identity:
+{self._read("IDENTITY.md")}
+
+Your memory:
+{self._read("MEMORY.md")}
+
+---
+
+Rules:
+- Reply as {agent} in first person
+- Keep it concise, like a normal chat message
+- If you have nothing meaningful to add, reply with exactly: NO_REPLY
+- No markdown formatting (no **, no ##, etc.)
+- Speak in Chinese
+
+Incoming message from the team chat:
+{message}"""
+
+        try:
+            # Remove CLAUDECODE env var to avoid nested session detection
+            env = {k: v for k, v in os.environ.items() if k != "CLAUDECODE"}
+            output = self._run(["claude", "-p", full_prompt, "--output-format", "text"],
+                               timeout=self.timeout, env=env, event_id=event_id)
+            if not output or "NO_REPLY" in output:
+                return None
+            return output
+        except subprocess.TimeoutExpired:
+            log.warning("backend_timeout", backend=self.name, timeout_s=self.timeout)
+            return None
+        except FileNotFoundError:
+            log.error("backend_error", backend=self.name, error="claude CLI not found in PATH")
+            return None
+        except Exception as e:
+            log.error("backend_error", backend=self.name, error=str(e))
+            return None
+
+    def clean(self, reply):
+        reply = re.sub(r'^\[.*?\]\s*', '', reply)
+        # Trim if too long for chat
+        if len(reply) > 2000:
+            reply = reply[:1997] + "..."
+        return reply
+
+
+# ============================================================
+# Stub
+# ============================================================
+
+class StubBackend(Backend):
+    """
+    Deterministic in-process backend. The reply, silence and latency of a
+    call depend only on the prompt, so the same input always produces the
+    same run. No CLI, network or model is involved.
+    """
+
+    name = "stub"
+    capabilities = frozenset({IMAGES, CANCEL})
+
+    def __init__(self, agent_name, joy_root="", latency_ms=50, jitter_ms=0, silent_ratio=0.0,
+                 sleep=time.sleep):
+        super().__init__(agent_name, joy_root)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.silent_ratio = silent_ratio
+        self.sleep = sleep  # replaced by mm-replay.py with its virtual clock
+        self._running = set()
+        self._cancelled = set()
+
+    def prompt(self, channel_name, username, message, history="", images=()):
+        context = f"[#{channel_name}] {username}: {message}"
+        if history:
+            context = f"[#{channel_name}, thread]\n{history}\n\n{username}: {message}"
+        if images:
+            context += f"\n({len(images)} image(s))"
+        return context
+
+    def call(self, prompt, images=(), event_id=""):
+        digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()
+        value = int(digest[:8], 16)
+        with self._lock:
+            self._running.add(event_id)
+        try:
+            self.sleep((self.latency_ms + value % (self.jitter_ms + 1)) / 1000)
+        finally:
+            with self._lock:
+                self._running.discard(event_id)
+                cancelled = event_id in self._cancelled
+                self._cancelled.discard(event_id)
+        if cancelled:
+            return None
+        if value / 0xFFFFFFFF < self.silent_ratio:
+            return None
+        return f"[stub:{self.agent_name}] {digest[:8]} ({len(prompt)} chars, {len(images)} images)"
+
+    def cancel(self, event_id):
+        with self._lock:
+            if event_id not in self._running:
+                return False
+            self._cancelled.add(event_id)
+        return True
+
+
+BACKENDS = {
+    "openclaw": OpenClawBackend,
+    "claude": ClaudeBackend,
+    "stub": StubBackend,
+}
+
+
+def add_arguments(parser, default="openclaw"):
+    """Register the backend flags on an argparse parser."""
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=default,
+                        help=f"Agent backend (default: {default})")
+    parser.add_argument("--backend-timeout", type=int, default=0,
+                        help="Backend call timeout in seconds (default: openclaw 180, claude 120)")
+    parser.add_argument("--stub-latency-ms", type=int, default=50,
+                        help="stub backend: base reply latency (default: 50)")
+    parser.add_argument("--stub-jitter-ms", type=int, default=0,
+                        help="stub backend: extra latency derived from the prompt hash (default: 0)")
+    parser.add_argument("--stub-silent-ratio", type=float, default=0.0,
+                        help="stub backend: share of prompts answered with silence (default: 0)")
+
+
+def from_args(agent_name, joy_root, args):
+    if args.backend == "stub":
+        return StubBackend(agent_name, joy_root, latency_ms=args.stub_latency_ms,
+                           jitter_ms=args.stub_jitter_ms, silent_ratio=args.stub_silent_ratio)
+    kwargs = {"timeout": args.backend_timeout} if args.backend_timeout else {}
+    return BACKENDS[args.backend](agent_name, joy_root, **kwargs)
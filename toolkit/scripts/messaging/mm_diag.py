@@ -0,0 +1,236 @@
+"""
+Event-loop health and on-demand profiling for the Mattermost listeners — JOYA Toolkit
+
+Cheap enough to leave on in production:
+
+  - Loop-lag gauge: a task sleeps for a fixed tick and measures how late it
+    wakes up. Lag stats (last / max / avg) are logged every --diag-report-s,
+    followed by a `listener_stats` line with the counters of registered
+    components (thread cache, reply cache).
+  - Blocked-loop detection: a watchdog thread notices when the gauge task
+    has not run for --diag-block-ms and logs the event-loop thread's stack
+    at that moment, so the offending callback (e.g. a sync HTTP call inside
+    the loop) is named in the log without attaching py-spy.
+  - Signal-triggered sampling profiler: `kill -USR1 <pid>` dumps every
+    thread's stack and samples all threads for --profile-seconds. Output goes
+    to --profile-dir as collapsed stacks (`*.folded`, for flamegraph.pl or
+    speedscope).
+  - uvloop is used when installed (disable with --no-uvloop).
+
+--asyncio-debug additionally turns on asyncio's own debug mode with
+slow_callback_duration set to the block threshold. That mode is more
+expensive and is meant for short investigations.
+"""
+
+import asyncio
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import mm_log as log
+
+_TICK_S = 0.25
+
+
+def install_fast_loop(enabled=True):
+    """Use uvloop's event loop policy if available. Returns the loop name."""
+    if enabled:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+        except ImportError:
+            pass
+    return "asyncio"
+
+
+def _format_stack(frame, limit=20):
+    return "".join(traceback.format_stack(frame, limit=limit))
+
+
+def _collapse(frame):
+    """Frame → 'file:func;file:func;...' root-first, as used by flamegraph.pl."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class Diagnostics:
+    """Loop-lag gauge, blocked-loop watchdog and SIGUSR1 sampling profiler."""
+
+    def __init__(self, agent, block_ms=100, report_s=60, profile_seconds=10,
+                 profile_dir="/tmp", profile_interval_ms=5, asyncio_debug=False):
+        self.agent = agent
+        self.block_s = block_ms / 1000
+        self.report_s = report_s
+        self.profile_seconds = profile_seconds
+        self.profile_dir = profile_dir
+        self.profile_interval_s = profile_interval_ms / 1000
+        self.asyncio_debug = asyncio_debug
+
+        self.lag_last_ms = 0.0
+        self.lag_max_ms = 0.0
+        self._lag_sum_ms = 0.0
+        self._lag_n = 0
+        self.blocked_count = 0
+
+        self._providers = {}  # name → stats() callable
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._profiling = threading.Lock()
+
+    # --------------------------------------------------------
+    # Entry points
+    # --------------------------------------------------------
+
+    async def run(self, coro):
+        """Start the monitors on the running loop, then await `coro`."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if self.asyncio_debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.block_s
+            log.attach("asyncio")
+        self._heartbeat = time.monotonic()
+        threading.Thread(target=self._watchdog, name="mm-diag-watchdog", daemon=True).start()
+        gauge = asyncio.ensure_future(self._gauge())
+        try:
+            return await coro
+        finally:
+            gauge.cancel()
+
+    def install_signal(self, signum=getattr(signal, "SIGUSR1", None)):
+        """Dump stacks and start a sampling profile when `signum` is received."""
+        if signum is None:
+            return
+        signal.signal(signum, lambda *_: threading.Thread(
+            target=self.profile, name="mm-diag-profiler", daemon=True).start())
+
+    def add_stats(self, name, fn):
+        """Report `fn()` under `name` in the periodic listener_stats line."""
+        self._providers[name] = fn
+
+    def listener_stats(self):
+        return {name: fn() for name, fn in self._providers.items()}
+
+    def stats(self):
+        return {
+            "lag_last_ms": round(self.lag_last_ms, 1),
+            "lag_max_ms": round(self.lag_max_ms, 1),
+            "lag_avg_ms": round(self._lag_sum_ms / self._lag_n, 1) if self._lag_n else 0.0,
+            "blocked": self.blocked_count,
+        }
+
+    # --------------------------------------------------------
+    # Loop lag gauge
+    # --------------------------------------------------------
+
+    async def _gauge(self):
+        next_report = time.monotonic() + self.report_s
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(_TICK_S)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag_ms = max(0.0, (now - start - _TICK_S) * 1000)
+            self.lag_last_ms = lag_ms
+            self.lag_max_ms = max(self.lag_max_ms, lag_ms)
+            self._lag_sum_ms += lag_ms
+            self._lag_n += 1
+            if now >= next_report:
+                log.info("loop_health", **self.stats())
+                if self._providers:
+                    log.info("listener_stats", **self.listener_stats())
+                self.lag_max_ms = 0.0
+                self._lag_sum_ms = 0.0
+                self._lag_n = 0
+                next_report = now + self.report_s
+
+    # --------------------------------------------------------
+    # Blocked-loop watchdog
+    # --------------------------------------------------------
+
+    def _watchdog(self):
+        reported = None  # heartbeat value already reported as blocked
+        while True:
+            time.sleep(0.05)
+            beat = self._heartbeat
+            if reported is not None and beat != reported:
+                log.warning("loop_unblocked", blocked_ms=int((beat - reported - _TICK_S) * 1000))
+                reported = None
+            if reported is None and time.monotonic() - beat - _TICK_S >= self.block_s:
+                reported = beat
+                self.blocked_count += 1
+                frame = sys._current_frames().get(self._loop_thread_id)
+                log.warning("loop_blocked", threshold_ms=int(self.block_s * 1000),
+                            stack=_format_stack(frame) if frame else "")
+
+    # --------------------------------------------------------
+    # Sampling profiler
+    # --------------------------------------------------------
+
+    def profile(self):
+        """Dump current stacks, then sample all threads for profile_seconds."""
+        if not self._profiling.acquire(blocking=False):
+            log.warning("profile_busy")
+            return
+        try:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            base = os.path.join(self.profile_dir, f"mm-profile-{self.agent}-{stamp}")
+            me = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+
+            with open(f"{base}.stacks.txt", "w") as f:
+                for tid, frame in sys._current_frames().items():
+                    if tid == me:
+                        continue
+                    f.write(f"--- thread {names.get(tid, tid)} ---\n{_format_stack(frame, limit=None)}\n")
+
+            counts = collections.Counter()
+            samples = 0
+            deadline = time.monotonic() + self.profile_seconds
+            while time.monotonic() < deadline:
+                for tid, frame in sys._current_frames().items():
+                    if tid != me:
+                        counts[f"{names.get(tid, tid)};{_collapse(frame)}"] += 1
+                samples += 1
+                time.sleep(self.profile_interval_s)
+
+            with open(f"{base}.folded", "w") as f:
+                for stack, n in counts.most_common():
+                    f.write(f"{stack} {n}\n")
+            log.info("profile_written", samples=samples, stacks=f"{base}.stacks.txt",
+                     folded=f"{base}.folded")
+        except Exception as e:
+            log.error("profile_error", error=str(e))
+        finally:
+            self._profiling.release()
+
+
+def add_arguments(parser):
+    """Register the diagnostics flags on an argparse parser."""
+    parser.add_argument("--diag-block-ms", type=int, default=100,
+                        help="Report the loop as blocked after this many ms without progress (default: 100)")
+    parser.add_argument("--diag-report-s", type=int, default=60,
+                        help="Log loop-lag stats every N seconds (default: 60)")
+    parser.add_argument("--profile-seconds", type=int, default=10,
+                        help="SIGUSR1 sampling profile duration (default: 10)")
+    parser.add_argument("--profile-dir", default="/tmp",
+                        help="Directory for SIGUSR1 stack dumps and profiles (default: /tmp)")
+    parser.add_argument("--asyncio-debug", action="store_true",
+                        help="Enable asyncio debug mode with slow-callback warnings (costly)")
+    parser.add_argument("--no-uvloop", action="store_true",
+                        help="Use the stock asyncio loop even if uvloop is installed")
+
+
+def from_args(agent, args):
+    return Diagnostics(agent, block_ms=args.diag_block_ms, report_s=args.diag_report_s,
+                       profile_seconds=args.profile_seconds, profile_dir=args.profile_dir,
+                       asyncio_debug=args.asyncio_debug)
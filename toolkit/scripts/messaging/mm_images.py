@@ -0,0 +1,201 @@
+"""
+Image attachment preprocessing for the Mattermost listeners — JOYA Toolkit
+
+Turns a Mattermost file_id into a small, metadata-free image on disk that is
+cheap to hand to a vision model:
+
+  1. Read /files/{id}/info (name, mime, dimensions, preview availability).
+  2. Pick the smallest server-side variant that still covers the target size:
+     /thumbnail (≤120x100), /preview (≤1920 wide), else the original file.
+     Variants are only used when the server generated them, and a failed
+     variant download falls back to the original.
+  3. Downscale to --image-max-dim, apply EXIF orientation, drop EXIF/ICC/XMP
+     and re-encode (webp by default).
+  4. Cache the result by content hash, so re-posted and cross-posted images
+     are processed once.
+
+Pillow is optional. Without it the chosen variant is stored as-is (the
+preview endpoint alone usually removes most of the size). Images Pillow
+cannot decode or re-encode (HEIC, SVG, ...) are stored as-is too.
+
+Requirements (optional):
+    pip3 install Pillow
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+import urllib.request
+
+import mm_log as log
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Mattermost server-side variant sizes (model/file_info.go)
+THUMBNAIL_W, THUMBNAIL_H = 120, 100
+PREVIEW_W = 1920
+
+FORMATS = {
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "png": ("PNG", "png", "image/png"),
+}
+
+
+def _variant_size(w, h, max_w, max_h=0):
+    """Size of a variant scaled down (never up) to fit max_w x max_h (0 = unbounded)."""
+    scale = 1.0
+    if max_w and w > max_w:
+        scale = min(scale, max_w / w)
+    if max_h and h > max_h:
+        scale = min(scale, max_h / h)
+    return int(w * scale), int(h * scale)
+
+
+class ImagePipeline:
+    """Fetch, downscale, re-encode and cache Mattermost image attachments."""
+
+    def __init__(self, mm_url, token, ssl_ctx, cache_dir="~/.openclaw/mm-images",
+                 max_dim=1568, fmt="webp", quality=85, enabled=True):
+        self.mm_url = mm_url
+        self.token = token
+        self.ssl_ctx = ssl_ctx
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_dim = max_dim
+        self.fmt = fmt if fmt in FORMATS else "webp"
+        self.quality = quality
+        self.enabled = enabled and Image is not None
+        self._by_file_id = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if enabled and Image is None:
+            log.warning("image_preprocess_disabled", reason="Pillow not installed (pip3 install Pillow)")
+
+    # --------------------------------------------------------
+    # HTTP
+    # --------------------------------------------------------
+
+    def _get(self, path, timeout):
+        req = urllib.request.Request(
+            f"{self.mm_url}/api/v4{path}",
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+        return urllib.request.urlopen(req, timeout=timeout, context=self.ssl_ctx).read()
+
+    # --------------------------------------------------------
+    # Pipeline
+    # --------------------------------------------------------
+
+    def fetch(self, file_id):
+        """Return (path, name, mime) for an image attachment, or None for non-images/errors."""
+        cached = self._by_file_id.get(file_id)
+        if cached and os.path.isfile(cached[0]):
+            log.debug("image_cache_hit", file_id=file_id, path=cached[0], key="file_id")
+            return cached
+
+        try:
+            info = json.loads(self._get(f"/files/{file_id}/info", timeout=10))
+            name = info.get("name", "file")
+            mime = info.get("mime_type", "")
+            if not mime.startswith("image/"):
+                return None
+
+            variant = self._choose_variant(info)
+            try:
+                data = self._get(f"/files/{file_id}{variant}", timeout=30)
+            except Exception as e:
+                if not variant:
+                    raise
+                log.info("image_variant_error", file_id=file_id, variant=variant, error=str(e))
+                variant = ""
+                data = self._get(f"/files/{file_id}", timeout=30)
+            if variant:
+                # Server-side previews and thumbnails are always JPEG.
+                mime = "image/jpeg"
+            result = self._store(data, name, mime)
+        except Exception as e:
+            log.warning("image_download_error", file_id=file_id, error=str(e))
+            return None
+
+        log.info("image_ready", file_id=file_id, name=name, variant=variant or "/",
+                 orig_bytes=info.get("size", 0), fetched_bytes=len(data),
+                 stored_bytes=os.path.getsize(result[0]), path=result[0])
+        self._by_file_id[file_id] = result
+        return result
+
+    def _choose_variant(self, info):
+        """Smallest endpoint suffix whose long side still reaches the target size."""
+        w, h = info.get("width") or 0, info.get("height") or 0
+        # Mattermost sets width/height for SVGs too, but generates neither variant for them.
+        if not w or not h or not info.get("has_preview_image"):
+            return ""
+        target = min(self.max_dim, max(w, h))
+        if max(_variant_size(w, h, THUMBNAIL_W, THUMBNAIL_H)) >= target:
+            return "/thumbnail"
+        if max(_variant_size(w, h, PREVIEW_W)) >= target:
+            return "/preview"
+        return ""
+
+    def _store(self, data, name, mime):
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        if not self.enabled:
+            return self._store_raw(data, digest, name, mime)
+
+        pil_fmt, ext, out_mime = FORMATS[self.fmt]
+        path = os.path.join(self.cache_dir, f"{digest}-{self.max_dim}q{self.quality}.{ext}")
+        if os.path.isfile(path):
+            log.debug("image_cache_hit", path=path, key="content")
+            return (path, name, out_mime)
+
+        try:
+            self._write(path, self._reencode(data, pil_fmt))
+        except Exception as e:
+            # Formats Pillow cannot read (HEIC, SVG, ...) still reach the agent unchanged.
+            log.info("image_passthrough", name=name, mime=mime, error=str(e))
+            return self._store_raw(data, digest, name, mime)
+        return (path, name, out_mime)
+
+    def _store_raw(self, data, digest, name, mime):
+        subtype = mime.split("/", 1)[1] if "/" in mime else ""
+        ext = subtype.split("+", 1)[0].replace("jpeg", "jpg") or "png"
+        path = os.path.join(self.cache_dir, f"{digest}.{ext}")
+        if not os.path.isfile(path):
+            self._write(path, data)
+        return (path, name, mime)
+
+    def _reencode(self, data, pil_fmt):
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((self.max_dim, self.max_dim))
+        if pil_fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+            img = img.convert("RGBA")
+
+        # Saving without exif=/icc_profile= drops the source metadata.
+        buf = io.BytesIO()
+        img.save(buf, format=pil_fmt, quality=self.quality, optimize=True)
+        return buf.getvalue()
+
+    @staticmethod
+    def _write(path, data):
+        tmp = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def add_arguments(parser):
+    """Register the image preprocessing flags on an argparse parser."""
+    parser.add_argument("--image-max-dim", type=int, default=1568,
+                        help="Downscale attachments so the long side fits this many pixels (default: 1568)")
+    parser.add_argument("--image-format", default="webp", choices=sorted(FORMATS),
+                        help="Re-encode attachments to this format (default: webp)")
+    parser.add_argument("--image-quality", type=int, default=85,
+                        help="Encoder quality for webp/jpeg (default: 85)")
+    parser.add_argument("--no-image-preprocess", action="store_true",
+                        help="Store attachments as fetched, without resizing or re-encoding")
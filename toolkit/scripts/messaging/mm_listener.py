@@ -0,0 +1,556 @@
+"""
+Mattermost listener core — JOYA Toolkit
+Shared by mm-agent-listener.py (openclaw) and mm-agent-listener-claude.py
+(claude). Auto-configures from DIRECTORY.json. No hardcoded tokens or URLs.
+
+Pipeline:
+    decode    websocket frame → post (posted / post_edited / post_deleted)
+    filter    channel, own posts, anti-loop gates (on the event loop)
+    schedule  accepted posts are handled on the default executor
+    handle    username, attachments, thread history → backend prompt
+    post      reply into the channel or thread
+
+The backend (mm_backends.py) only builds the prompt and produces the reply,
+so every change to the pipeline applies to all backends:
+
+    python3 mm_listener.py --agent rex --backend openclaw
+    python3 mm_listener.py --agent ace --backend claude
+    python3 mm_listener.py --agent rex --backend stub --stub-latency-ms 200   # load tests
+
+Requirements:
+    pip3 install websockets
+    pip3 install Pillow   # optional: downscale/re-encode image attachments
+
+Logging:
+    Events are written as JSON lines by a background thread (see mm_log.py).
+    --log-file enables size-based rotation; --log-level / --log-debug-sample
+    control volume.
+
+Diagnostics:
+    Loop lag and blocked-loop stacks are logged automatically (see mm_diag.py).
+    kill -USR1 <pid> writes a stack dump and sampling profile to /tmp.
+
+Tracing:
+    --trace /tmp/session.trace.gz records the session for mm-replay.py.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import argparse
+import urllib.request
+import ssl
+
+import mm_log as log
+import mm_backends
+import mm_images
+import mm_diag
+import mm_replies
+import mm_trace
+import mm_threads
+
+try:
+    import websockets
+except ImportError:
+    print("❌ Missing dependency: pip3 install websockets")
+    sys.exit(1)
+
+# --- SSL context (skip verification for self-signed certs) ---
+_ssl_ctx = ssl.create_default_context()
+_ssl_ctx.check_hostname = False
+_ssl_ctx.verify_mode = ssl.CERT_NONE
+
+# ============================================================
+# Configuration — loaded from DIRECTORY.json
+# ============================================================
+
+def find_joy_root():
+    """Auto-detect JOY_ROOT from environment or script location."""
+    if os.environ.get("JOY_ROOT"):
+        return os.environ["JOY_ROOT"]
+    # Walk up from script: toolkit/scripts/messaging/ → root
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    candidate = os.path.normpath(os.path.join(script_dir, "..", "..", ".."))
+    if os.path.isfile(os.path.join(candidate, "AGENT_INIT.md")):
+        return candidate
+    log.error("config_error", reason="Cannot find JOY_ROOT. Set JOY_ROOT env or use --joy-root.")
+    sys.exit(1)
+
+
+def load_config(joy_root, agent_name):
+    """Load agent config from DIRECTORY.json."""
+    dir_path = os.path.join(joy_root, "my", "shared", "agents", "DIRECTORY.json")
+    if not os.path.isfile(dir_path):
+        log.error("config_error", reason="DIRECTORY.json not found", path=dir_path)
+        sys.exit(1)
+
+    directory = json.load(open(dir_path))
+    agents = directory.get("agents", {})
+
+    me = agents.get(agent_name)
+    if not me:
+        log.error("config_error", reason="Agent not found in DIRECTORY.json",
+                  available=list(agents.keys()))
+        sys.exit(1)
+
+    # Extract my Mattermost config
+    mm = me.get("adapters", {}).get("mattermost", me.get("mattermost", {}))
+    my_bot_token = mm.get("bot_token", "")
+    mm_url = mm.get("base_url", "")
+
+    if not my_bot_token or not mm_url:
+        log.error("config_error", reason="Mattermost config incomplete. Need bot_token and base_url.")
+        sys.exit(1)
+
+    # Resolve bot_user_id (fetch from API if not in directory)
+    my_bot_user_id = mm.get("bot_user_id", "")
+    if not my_bot_user_id:
+        my_bot_user_id = _fetch_bot_user_id(mm_url, my_bot_token)
+
+    # Build bot_id → name mapping from all agents
+    bot_id_to_name = {}
+    for name, info in agents.items():
+        a_mm = info.get("adapters", {}).get("mattermost", info.get("mattermost", {}))
+        bid = a_mm.get("bot_user_id", "")
+        if bid:
+            bot_id_to_name[bid] = name
+
+    # If we resolved our own, add it
+    if my_bot_user_id:
+        bot_id_to_name[my_bot_user_id] = agent_name
+
+    # Load channels from INFRASTRUCTURE.md or use defaults
+    channels = _load_channels(joy_root, mm_url, my_bot_token)
+
+    # Admin token (optional, for fetching usernames; falls back to bot token)
+    admin_token = mm.get("admin_token", my_bot_token)
+
+    return {
+        "agent_name": agent_name,
+        "mm_url": mm_url,
+        "mm_ws": mm_url.replace("http://", "ws://").replace("https://", "wss://") + "/api/v4/websocket",
+        "my_bot_token": my_bot_token,
+        "my_bot_user_id": my_bot_user_id,
+        "admin_token": admin_token,
+        "bot_id_to_name": bot_id_to_name,
+        "channels": channels,
+    }
+
+
+def _fetch_bot_user_id(mm_url, token):
+    """Fetch the bot's own user ID from Mattermost API."""
+    try:
+        req = urllib.request.Request(
+            f"{mm_url}/api/v4/users/me",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        data = json.loads(urllib.request.urlopen(req, timeout=10, context=_ssl_ctx).read())
+        return data.get("id", "")
+    except Exception as e:
+        log.warning("bot_user_id_error", error=str(e))
+        return ""
+
+
+def _load_channels(joy_root, mm_url, token):
+    """
+    Load monitored channels. Tries to read from instance config,
+    falls back to fetching all channels and monitoring 'office-general' and 'meetings'.
+    """
+    # Default monitored channel names
+    monitored_names = {"office-general", "meetings"}
+
+    # Try to fetch channel list from Mattermost
+    channels = {}
+    try:
+        # Get teams
+        req = urllib.request.Request(
+            f"{mm_url}/api/v4/users/me/teams",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        teams = json.loads(urllib.request.urlopen(req, timeout=10, context=_ssl_ctx).read())
+
+        for team in teams:
+            team_id = team["id"]
+            req = urllib.request.Request(
+                f"{mm_url}/api/v4/teams/{team_id}/channels?per_page=100",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            team_channels = json.loads(urllib.request.urlopen(req, timeout=10, context=_ssl_ctx).read())
+            for ch in team_channels:
+                if ch["name"] in monitored_names:
+                    channels[ch["id"]] = ch["name"]
+    except Exception as e:
+        log.warning("channel_discovery_error", error=str(e))
+
+    if not channels:
+        log.warning("no_channels", reason="Listener will accept all channels.")
+
+    return channels
+
+
+# ============================================================
+# Anti-loop state
+# ============================================================
+
+_bot_consecutive = 0
+_bot_consecutive_max = 4
+_last_bot_msg_time = 0
+_cooldown_seconds = 30
+_my_last_reply_time = 0
+_my_reply_min_interval = 5
+
+_user_cache = {}
+_thread_context_posts = 20
+
+# ============================================================
+# Core functions
+# ============================================================
+
+CFG = {}  # filled in main()
+BACKEND = None  # mm_backends.Backend, filled in main()
+IMAGES = None  # mm_images.ImagePipeline, filled in main() if the backend takes images
+THREADS = mm_threads.ThreadCache()  # replaced (or disabled) in main()
+REPLIES = None  # mm_replies.ReplyCache when --reply-cache-ttl is set
+
+_inflight = {}  # post id → handler state, for cancellation on delete
+
+
+def mm_post(channel_id, message, root_id=""):
+    """Create a post; returns its id ("" on failure)."""
+    body = {"channel_id": channel_id, "message": message}
+    if root_id:
+        body["root_id"] = root_id
+    data = json.dumps(body).encode()
+    req = urllib.request.Request(
+        f"{CFG['mm_url']}/api/v4/posts", data=data,
+        headers={"Authorization": f"Bearer {CFG['my_bot_token']}", "Content-Type": "application/json"},
+    )
+    try:
+        resp = urllib.request.urlopen(req, timeout=10, context=_ssl_ctx)
+        return json.loads(resp.read()).get("id", "")
+    except Exception as e:
+        log.error("mm_post_error", channel=channel_id, error=str(e))
+        return ""
+
+
+def get_username(user_id):
+    if user_id in _user_cache:
+        return _user_cache[user_id]
+    req = urllib.request.Request(
+        f"{CFG['mm_url']}/api/v4/users/{user_id}",
+        headers={"Authorization": f"Bearer {CFG['admin_token']}"},
+    )
+    try:
+        name = json.loads(urllib.request.urlopen(req, timeout=5, context=_ssl_ctx).read()).get("username", "unknown")
+    except:
+        name = "unknown"
+    _user_cache[user_id] = name
+    return name
+
+
+def fetch_thread(root_id):
+    req = urllib.request.Request(
+        f"{CFG['mm_url']}/api/v4/posts/{root_id}/thread",
+        headers={"Authorization": f"Bearer {CFG['admin_token']}"},
+    )
+    try:
+        return json.loads(urllib.request.urlopen(req, timeout=10, context=_ssl_ctx).read())
+    except Exception as e:
+        log.warning("thread_fetch_error", root_id=root_id, error=str(e))
+        return None
+
+
+def thread_history(root_id, exclude):
+    """Earlier posts of a thread as `name: message` lines ("" for top-level posts)."""
+    if not root_id or THREADS is None:
+        return ""
+    posts = THREADS.history(root_id, fetch_thread, exclude=exclude)
+    name_of = lambda uid: CFG["bot_id_to_name"].get(uid) or get_username(uid)
+    return mm_threads.format_history(posts, name_of, limit=_thread_context_posts)
+
+
+def should_i_respond(message, user_id):
+    global _bot_consecutive, _last_bot_msg_time, _my_last_reply_time
+
+    now = time.time()
+    is_bot = user_id in CFG["bot_id_to_name"]
+
+    if is_bot:
+        if now - _last_bot_msg_time < 60:
+            _bot_consecutive += 1
+        else:
+            _bot_consecutive = 1
+        _last_bot_msg_time = now
+
+        if _bot_consecutive > _bot_consecutive_max:
+            return False
+        if now - _my_last_reply_time < _cooldown_seconds and _bot_consecutive > 2:
+            return False
+
+        msg_lower = message.lower()
+        if f"@{CFG['agent_name']}" not in msg_lower:
+            import random
+            if random.random() < 0.7:
+                return False
+    else:
+        _bot_consecutive = 0
+
+    if now - _my_last_reply_time < _my_reply_min_interval:
+        return False
+
+    return True
+
+
+def download_file(file_id):
+    """Fetch an image attachment, downscaled and re-encoded by the image pipeline."""
+    return IMAGES.fetch(file_id)
+
+
+def call_backend(prompt, images=(), event_id=""):
+    return BACKEND.call(prompt, images=images, event_id=event_id)
+
+
+def cancel(event_id):
+    """Abort the backend call for a deleted post, if it is still running."""
+    state = _inflight.get(event_id)
+    if state is None or not BACKEND.supports(mm_backends.CANCEL):
+        return
+    state["cancelled"] = True
+    if BACKEND.cancel(event_id):
+        log.info("cancelled", event_id=event_id, stage="backend")
+
+
+def handle_message(channel_id, channel_name, user_id, message, file_ids=None,
+                   event_id="", received_at=None, root_id=""):
+    global _my_last_reply_time
+
+    t_start = time.time()
+    timings = {"queue_ms": _ms(received_at, t_start)} if received_at else {}
+    # Registered by listen() when the message was queued, so a delete is seen even before we run.
+    state = _inflight.setdefault(event_id, {"cancelled": False})
+    try:
+        # Thread replies and attachments depend on more than the text: never cached.
+        cacheable = REPLIES is not None and not root_id and not file_ids and not state["cancelled"]
+        cached = REPLIES.lookup(channel_id, message) if cacheable else None
+        if cached:
+            reply_cached(channel_id, channel_name, cached, event_id, received_at or t_start, timings)
+            return
+
+        username = CFG["bot_id_to_name"].get(user_id) or get_username(user_id)
+
+        image_paths = []
+        if file_ids and IMAGES is not None:
+            t_download = time.time()
+            for fid in file_ids[:4]:
+                result = download_file(fid)
+                if result:
+                    image_paths.append(result)
+            timings["download_ms"] = _ms(t_download, time.time())
+
+        t_thread = time.time()
+        history = thread_history(root_id, exclude=event_id)
+        if root_id:
+            timings["thread_ms"] = _ms(t_thread, time.time())
+
+        prompt = BACKEND.prompt(channel_name, username, message, history, image_paths)
+        log.debug("backend_call", event_id=event_id, channel=channel_name, stage="backend",
+                  backend=BACKEND.name, images=len(image_paths))
+        t_backend = time.time()
+        # A post deleted while it was waiting is not sent to the backend at all.
+        reply = None if state["cancelled"] else call_backend(prompt, images=image_paths, event_id=event_id)
+        timings["backend_ms"] = _ms(t_backend, time.time())
+    finally:
+        _inflight.pop(event_id, None)
+
+    if state["cancelled"]:
+        timings["total_ms"] = _ms(received_at or t_start, time.time())
+        log.info("dropped", event_id=event_id, channel=channel_name, stage="backend",
+                 reason="post deleted", **timings)
+    elif reply and "NO_REPLY" not in reply and "HEARTBEAT_OK" not in reply:
+        reply = BACKEND.clean(reply)
+        t_post = time.time()
+        post_id = mm_post(channel_id, reply, root_id=root_id)
+        _my_last_reply_time = time.time()
+        if cacheable:
+            REPLIES.store(channel_id, message, reply, post_id)
+        timings["post_ms"] = _ms(t_post, _my_last_reply_time)
+        timings["total_ms"] = _ms(received_at or t_start, time.time())
+        log.info("reply", event_id=event_id, channel=channel_name, stage="post",
+                 preview=reply[:80], **timings)
+    else:
+        timings["total_ms"] = _ms(received_at or t_start, time.time())
+        log.info("silent", event_id=event_id, channel=channel_name, stage="backend", **timings)
+
+
+def reply_cached(channel_id, channel_name, cached, event_id, start, timings):
+    """Answer a repeated question from the reply cache: link to the earlier reply or repost it."""
+    global _my_last_reply_time
+
+    if REPLIES.mode == "link" and cached["post_id"]:
+        message = f"{CFG['mm_url']}/_redirect/pl/{cached['post_id']}"
+    else:
+        message = cached["reply"]
+    t_post = time.time()
+    mm_post(channel_id, message)
+    _my_last_reply_time = time.time()
+    timings["post_ms"] = _ms(t_post, _my_last_reply_time)
+    timings["total_ms"] = _ms(start, time.time())
+    log.info("reply", event_id=event_id, channel=channel_name, stage="post", cache="hit",
+             cached_post=cached["post_id"], age_s=int(REPLIES.clock() - cached["at"]),
+             preview=message[:80], **timings)
+
+
+def _ms(start, end):
+    return int((end - start) * 1000)
+
+
+async def listen():
+    while True:
+        try:
+            log.info("connecting", url=CFG["mm_url"])
+            ws_kwargs = {"ping_interval": 30, "ping_timeout": 10}
+            if CFG["mm_ws"].startswith("wss://"):
+                ws_kwargs["ssl"] = _ssl_ctx
+
+            async with websockets.connect(CFG["mm_ws"], **ws_kwargs) as ws:
+                await ws.send(json.dumps({
+                    "seq": 1,
+                    "action": "authentication_challenge",
+                    "data": {"token": CFG["admin_token"]}
+                }))
+
+                for _ in range(5):
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=3)
+                        if json.loads(raw).get("status") == "OK":
+                            break
+                    except asyncio.TimeoutError:
+                        break
+
+                log.info("listening", channels=list(CFG["channels"].values()))
+
+                async for raw in ws:
+                    try:
+                        evt = json.loads(raw)
+                    except:
+                        continue
+
+                    event_type = evt.get("event")
+                    log.debug("ws_frame", type=event_type or "", bytes=len(raw))
+                    if event_type not in ("posted", "post_edited", "post_deleted"):
+                        continue
+
+                    post_str = evt.get("data", {}).get("post", "{}")
+                    post = json.loads(post_str) if isinstance(post_str, str) else post_str
+                    received_at = time.time()
+                    event_id = post.get("id", "")
+
+                    user_id = post.get("user_id", "")
+                    message = post.get("message", "").strip()
+                    channel_id = post.get("channel_id", "")
+                    file_ids = post.get("file_ids", []) or []
+                    root_id = post.get("root_id", "")
+
+                    # Skip unmonitored channels (if channels configured)
+                    if CFG["channels"] and channel_id not in CFG["channels"]:
+                        continue
+
+                    # Keep cached thread histories current, own replies included
+                    if THREADS is not None:
+                        THREADS.apply(event_type, post)
+                    if event_type == "post_deleted":
+                        cancel(event_id)
+                    if event_type != "posted":
+                        continue
+
+                    if IMAGES is None:
+                        file_ids = []
+                    if not message and not file_ids:
+                        continue
+                    if user_id == CFG["my_bot_user_id"]:
+                        continue
+
+                    channel_name = CFG["channels"].get(channel_id, channel_id)
+
+                    if not should_i_respond(message, user_id):
+                        log.debug("suppressed", event_id=event_id, channel=channel_name, stage="filter")
+                        continue
+
+                    # Username lookups are REST calls; they happen in the handler, off the loop.
+                    log.info("accepted", event_id=event_id, channel=channel_name, stage="filter",
+                             user=CFG["bot_id_to_name"].get(user_id, user_id), preview=message[:80],
+                             files=len(file_ids), root_id=root_id)
+
+                    _inflight[event_id] = {"cancelled": False}
+                    loop = asyncio.get_event_loop()
+                    loop.run_in_executor(None, handle_message, channel_id, channel_name, user_id, message, file_ids,
+                                         event_id, received_at, root_id)
+
+        except Exception as e:
+            log.warning("ws_error", error=str(e), reconnect_s=3)
+            await asyncio.sleep(3)
+
+
+def main(backend="openclaw", description="JOYA — Mattermost Listener"):
+    global CFG, BACKEND, IMAGES, THREADS, REPLIES, _thread_context_posts
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--agent", default=os.environ.get("AGENT_NAME", ""),
+                        help="Agent name (or set AGENT_NAME env)")
+    parser.add_argument("--joy-root", default="",
+                        help="JOYA root (or set JOY_ROOT env)")
+    mm_backends.add_arguments(parser, default=backend)
+    log.add_arguments(parser)
+    mm_diag.add_arguments(parser)
+    mm_threads.add_arguments(parser)
+    mm_replies.add_arguments(parser)
+    mm_trace.add_arguments(parser)
+    mm_images.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.joy_root:
+        os.environ["JOY_ROOT"] = args.joy_root
+
+    agent_name = args.agent
+    if not agent_name:
+        print("❌ Agent name required. Use --agent <name> or set AGENT_NAME env.")
+        sys.exit(1)
+
+    log.setup_from_args(agent_name, args)
+
+    joy_root = find_joy_root()
+    CFG = load_config(joy_root, agent_name)
+    BACKEND = mm_backends.from_args(agent_name, joy_root, args)
+    if BACKEND.supports(mm_backends.IMAGES):
+        IMAGES = mm_images.ImagePipeline(
+            CFG["mm_url"], CFG["admin_token"], _ssl_ctx,
+            max_dim=args.image_max_dim, fmt=args.image_format, quality=args.image_quality,
+            enabled=not args.no_image_preprocess,
+        )
+    THREADS = None if args.no_thread_context else mm_threads.from_args(args)
+    _thread_context_posts = args.thread_context_posts
+    REPLIES = mm_replies.from_args(agent_name, joy_root, args)
+
+    loop_impl = mm_diag.install_fast_loop(not args.no_uvloop)
+    diag = mm_diag.from_args(agent_name, args)
+    diag.install_signal()
+    if THREADS is not None:
+        diag.add_stats("thread_cache", THREADS.stats)
+    if REPLIES is not None:
+        diag.add_stats("reply_cache", REPLIES.stats)
+
+    log.info("startup", backend=BACKEND.name, capabilities=sorted(BACKEND.capabilities),
+             pid=os.getpid(), loop=loop_impl, joy_root=joy_root, mm_url=CFG["mm_url"],
+             bot_id=CFG["my_bot_user_id"], channels=CFG["channels"])
+
+    if args.trace:
+        mm_trace.record(sys.modules[__name__], args.trace, CFG)
+        log.info("trace_recording", path=args.trace)
+
+    asyncio.run(diag.run(listen()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Structured logging for the Mattermost listeners — JOYA Toolkit
+
+Log calls never touch the disk. Records go onto a bounded in-memory queue
+and a background thread formats them as JSON lines and writes them out, so
+a slow log volume cannot stall the asyncio loop or the executor threads.
+
+Usage:
+    import mm_log as log
+
+    log.setup("rex", path="/tmp/mm-listener-rex.log", level="info")
+    log.info("received", event_id=post_id, channel="meetings", stage="filter")
+    log.debug("ws_frame", type="posted")  # every debug record is sampled by --log-debug-sample
+
+Each line looks like:
+    {"ts": 1772700000.123, "level": "info", "agent": "rex", "event": "reply",
+     "event_id": "p1", "channel": "meetings", "stage": "post", "backend_ms": 8123}
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+_QUEUE_MAX = 10000
+
+_logger = logging.getLogger("joya.mm")
+_logger.propagate = False
+_listener = None
+_agent = ""
+_dropped = 0
+
+
+class JsonFormatter(logging.Formatter):
+    """Render a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "agent": _agent,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _SampleFilter(logging.Filter):
+    """Keep a fraction of DEBUG records; INFO and above always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when full."""
+
+    def prepare(self, record):
+        # Only the JSON formatter on the writer thread renders the record;
+        # here we just freeze the message and traceback text.
+        fields = dict(getattr(record, "fields", {}))
+        if record.exc_info:
+            fields["exc"] = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.fields = fields
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped += 1
+
+
+def setup(agent, path=None, level="info", debug_sample=1.0,
+          max_bytes=10 * 1024 * 1024, backups=5, stream=None):
+    """
+    Start the background writer. Logs go to `stream` (default stdout) unless
+    `path` is given, in which case the file is rotated at `max_bytes` keeping
+    `backups` copies.
+    """
+    global _listener, _agent
+    if _listener:
+        return
+    _agent = agent
+
+    if path:
+        target = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    else:
+        target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter())
+
+    q = queue.Queue(maxsize=_QUEUE_MAX)
+    handler = _DroppingQueueHandler(q)
+    handler.addFilter(_SampleFilter(debug_sample))
+
+    _logger.handlers[:] = [handler]
+    _logger.setLevel(LEVELS.get(level, logging.INFO))
+
+    _listener = logging.handlers.QueueListener(q, target, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if not _listener:
+        return
+    if _dropped:
+        _logger.warning("log_dropped", extra={"fields": {"count": _dropped}})
+    _listener.stop()
+    _listener = None
+
+
+def attach(name):
+    """Route another stdlib logger (e.g. "asyncio") through the same queue."""
+    other = logging.getLogger(name)
+    other.handlers[:] = _logger.handlers
+    other.propagate = False
+
+
+def log(level, event, exc_info=False, **fields):
+    _logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def debug(event, **fields):
+    if _logger.isEnabledFor(logging.DEBUG):
+        _logger.debug(event, extra={"fields": fields})
+
+
+def info(event, **fields):
+    _logger.info(event, extra={"fields": fields})
+
+
+def warning(event, **fields):
+    _logger.warning(event, extra={"fields": fields})
+
+
+def error(event, exc_info=False, **fields):
+    _logger.error(event, exc_info=exc_info, extra={"fields": fields})
+
+
+def add_arguments(parser):
+    """Register the shared logging flags on an argparse parser."""
+    parser.add_argument("--log-file", default=os.environ.get("MM_LOG_FILE", ""),
+                        help="Write JSON logs to this file with rotation (default: stdout)")
+    parser.add_argument("--log-level", default=os.environ.get("MM_LOG_LEVEL", "info"),
+                        choices=sorted(LEVELS), help="Minimum log level (default: info)")
+    parser.add_argument("--log-debug-sample", type=float, default=1.0,
+                        help="Fraction of debug lines to keep, 0.0-1.0 (default: 1.0)")
+    parser.add_argument("--log-max-mb", type=float, default=10,
+                        help="Rotate the log file at this size (default: 10)")
+    parser.add_argument("--log-backups", type=int, default=5,
+                        help="Rotated log files to keep (default: 5)")
+
+
+def setup_from_args(agent, args):
+    setup(agent, path=args.log_file or None, level=args.log_level,
+          debug_sample=args.log_debug_sample,
+          max_bytes=int(args.log_max_mb * 1024 * 1024), backups=args.log_backups)
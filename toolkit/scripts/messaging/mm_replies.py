@@ -0,0 +1,161 @@
+"""
+Reply cache for repeated questions — JOYA Toolkit
+
+The same question often comes back within minutes: asked again, cross-posted
+to another channel, or deleted and re-sent after an edit. With the cache on,
+a repeat is answered from the earlier reply and the backend is not called:
+
+  - Keyed on agent, channel scope and normalized message text (case,
+    punctuation, @mentions and whitespace ignored).
+  - Entries expire after --reply-cache-ttl seconds (0, the default, turns
+    the cache off) and are bounded by --reply-cache-size (LRU).
+  - Everything is dropped when the agent's MEMORY.md or IDENTITY.md changes,
+    since the answer may change with them.
+  - --reply-cache-mode link posts a permalink to the earlier reply (shown as
+    a preview by Mattermost); reuse posts the earlier text again.
+
+Thread replies and posts with attachments are never cached: their answer
+depends on more than the message text. Neither are short messages ("hi",
+"ok", "+1", "谢谢"): a normalized text needs at least MIN_WORDS words or
+MIN_CHARS characters, with each CJK character counting as two.
+"""
+
+import collections
+import os
+import re
+import threading
+import time
+import unicodedata
+
+import mm_log as log
+
+_MENTION = re.compile(r"@[\w.-]+")
+_APOSTROPHE = re.compile(r"['’]")
+_PUNCT = re.compile(r"[^\w\s]")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+MIN_WORDS = 3
+MIN_CHARS = 12
+
+
+def normalize(text):
+    """Cache key form of a message: NFKC, casefolded, no mentions or punctuation."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _PUNCT.sub(" ", _APOSTROPHE.sub("", _MENTION.sub(" ", text)))
+    return " ".join(text.split())
+
+
+def substantial(norm):
+    """Whether a normalized text is long enough to be worth caching."""
+    if len(norm.split()) >= MIN_WORDS:
+        return True
+    chars = len(norm.replace(" ", "")) + len(_CJK.findall(norm))
+    return chars >= MIN_CHARS
+
+
+class ReplyCache:
+    """TTL + LRU cache of replies, invalidated when watched files change."""
+
+    def __init__(self, agent, ttl_s=600, max_entries=500, scope="channel", mode="link",
+                 watch=(), clock=time.time):
+        self.agent = agent
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.scope = scope
+        self.mode = mode
+        self.watch = list(watch)
+        self.clock = clock  # replaced by mm-replay.py with its virtual clock
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()  # key → entry dict
+        self._signature = self._stat()
+        self._lock = threading.Lock()
+
+    def _key(self, channel_id, text):
+        norm = normalize(text)
+        if not substantial(norm):
+            return None
+        return (self.agent, channel_id if self.scope == "channel" else "*", norm)
+
+    def _stat(self):
+        sig = []
+        for path in self.watch:
+            try:
+                st = os.stat(path)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _check_files(self):
+        """Drop every entry if a watched file changed (caller holds the lock)."""
+        sig = self._stat()
+        if sig != self._signature:
+            self._signature = sig
+            if self._entries:
+                self.invalidations += 1
+                log.info("reply_cache_invalidated", entries=len(self._entries))
+            self._entries.clear()
+
+    def lookup(self, channel_id, text):
+        """The cached entry for this question, or None."""
+        key = self._key(channel_id, text)
+        if key is None:
+            return None
+        with self._lock:
+            self._check_files()
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry["at"] > self.ttl_s:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def store(self, channel_id, text, reply, post_id=""):
+        key = self._key(channel_id, text)
+        if key is None:
+            return
+        with self._lock:
+            self._check_files()
+            self._entries[key] = {"reply": reply, "post_id": post_id, "channel_id": channel_id,
+                                  "at": self.clock()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "invalidations": self.invalidations}
+
+
+def add_arguments(parser):
+    """Register the reply cache flags on an argparse parser."""
+    parser.add_argument("--reply-cache-ttl", type=int, default=0,
+                        help="Answer repeated questions from replies at most this many seconds old "
+                             "(default: 0 = off)")
+    parser.add_argument("--reply-cache-size", type=int, default=500,
+                        help="Cached replies kept, LRU (default: 500)")
+    parser.add_argument("--reply-cache-scope", choices=["channel", "all"], default="channel",
+                        help="Share cached replies within a channel or across all monitored channels "
+                             "(default: channel)")
+    parser.add_argument("--reply-cache-mode", choices=["link", "reuse"], default="link",
+                        help="On a hit, link to the earlier reply or post its text again (default: link)")
+
+
+def from_args(agent, joy_root, args, clock=time.time):
+    """A ReplyCache for `agent`, or None when --reply-cache-ttl is 0."""
+    if args.reply_cache_ttl <= 0:
+        return None
+    agent_dir = os.path.join(joy_root, "my", "agents", agent)
+    return ReplyCache(agent, ttl_s=args.reply_cache_ttl, max_entries=args.reply_cache_size,
+                      scope=args.reply_cache_scope, mode=args.reply_cache_mode,
+                      watch=[os.path.join(agent_dir, "MEMORY.md"), os.path.join(agent_dir, "IDENTITY.md")],
+                      clock=clock)
@@ -0,0 +1,221 @@
+"""
+Thread context cache for the Mattermost listeners — JOYA Toolkit
+
+Keeps recent thread histories in memory so a reply in a thread can be
+answered with its context without a REST round trip per message:
+
+  - Updated incrementally from websocket `posted`, `post_edited` and
+    `post_deleted` events (including the listener's own replies).
+  - A new root post starts a complete thread for free; any other thread is
+    fetched once from /posts/{root_id}/thread on a cold miss. Events for a
+    thread arriving while its fetch is in flight are buffered and merged
+    into the snapshot, so nothing posted meanwhile is lost.
+  - Bounded by thread count (LRU), posts kept per thread and total message
+    characters.
+
+Thread-safe: the loop thread applies events while executor threads read.
+"""
+
+import collections
+import threading
+
+import mm_log as log
+
+
+class _Thread:
+    __slots__ = ("posts", "chars")
+
+    def __init__(self):
+        self.posts = collections.OrderedDict()  # post_id → post dict, in create_at order
+        self.chars = 0
+
+
+def _slim(post):
+    return {
+        "id": post.get("id", ""),
+        "user_id": post.get("user_id", ""),
+        "message": post.get("message", ""),
+        "create_at": post.get("create_at", 0),
+        "update_at": post.get("update_at", 0),
+    }
+
+
+class ThreadCache:
+    """LRU cache of thread histories keyed by root post id."""
+
+    def __init__(self, max_threads=200, max_posts=50, max_chars=2_000_000):
+        self.max_threads = max_threads
+        self.max_posts = max_posts
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._threads = collections.OrderedDict()  # root_id → _Thread
+        self._pending = {}  # root_id → {"events": [...], "fetches": n} while a cold fetch runs
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    # --------------------------------------------------------
+    # Websocket events
+    # --------------------------------------------------------
+
+    def apply(self, event, post):
+        """Apply a posted / post_edited / post_deleted event."""
+        post_id = post.get("id", "")
+        if not post_id:
+            return
+        root_id = post.get("root_id") or post_id
+        with self._lock:
+            pending = self._pending.get(root_id)
+            if pending is not None and root_id not in self._threads:
+                # A cold fetch is in flight; merged into its snapshot in history().
+                pending["events"].append((event, _slim(post)))
+                return
+            self._apply(event, root_id, post_id, _slim(post), create=not post.get("root_id"))
+
+    def _apply(self, event, root_id, post_id, post, create):
+        """Apply one event (caller holds the lock). `create`: a posted root may start a thread."""
+        thread = self._threads.get(root_id)
+        if event == "post_deleted":
+            if post_id == root_id:
+                self._drop(root_id)
+            elif thread and post_id in thread.posts:
+                self._remove(thread, post_id)
+            return
+        if thread is None:
+            # A new root post is a complete thread; replies to unknown
+            # threads are left for a cold fetch when they are needed.
+            if event != "posted" or not create:
+                return
+            thread = self._threads[root_id] = _Thread()
+        old = thread.posts.get(post_id)
+        if event == "post_edited" and old is None:
+            return
+        if old is not None and old["update_at"] > post["update_at"]:
+            return  # the snapshot already has a newer version
+        self._put(thread, post)
+        self._threads.move_to_end(root_id)
+        self._evict()
+
+    # --------------------------------------------------------
+    # Reads
+    # --------------------------------------------------------
+
+    def history(self, root_id, fetch, exclude=""):
+        """
+        Posts of a thread in order, oldest first, without `exclude`.
+        `fetch(root_id)` is called on a cold miss and must return the
+        /posts/{id}/thread response (or None on error).
+        """
+        with self._lock:
+            thread = self._threads.get(root_id)
+            if thread is not None:
+                self.hits += 1
+                self._threads.move_to_end(root_id)
+                return [p for pid, p in thread.posts.items() if pid != exclude]
+            self.misses += 1
+            pending = self._pending.setdefault(root_id, {"events": [], "fetches": 0})
+            pending["fetches"] += 1
+
+        data = None
+        try:
+            data = fetch(root_id)
+        finally:
+            with self._lock:
+                pending["fetches"] -= 1
+                thread = self._threads.get(root_id)
+                if data and thread is None:
+                    thread = self._install(root_id, data, pending["events"])
+                if pending["fetches"] == 0 and self._pending.get(root_id) is pending:
+                    del self._pending[root_id]
+        if thread is None:
+            return []
+        with self._lock:
+            return [p for pid, p in thread.posts.items() if pid != exclude]
+
+    def _install(self, root_id, data, events):
+        """Cache a REST snapshot plus the events buffered during its fetch (caller holds the lock)."""
+        posts = data.get("posts", {})
+        thread = self._threads[root_id] = _Thread()
+        for post in sorted(posts.values(), key=lambda p: p.get("create_at", 0)):
+            if not post.get("delete_at"):
+                self._put(thread, _slim(post))
+        for event, post in events:
+            self._apply(event, root_id, post["id"], post, create=True)
+        thread = self._threads.get(root_id)  # a buffered root deletion drops it again
+        if thread is not None:
+            self._threads.move_to_end(root_id)
+            self._evict()
+            log.debug("thread_fetched", root_id=root_id, posts=len(thread.posts), merged=len(events))
+        return self._threads.get(root_id)
+
+    def stats(self):
+        with self._lock:
+            return {"threads": len(self._threads), "chars": self._chars,
+                    "hits": self.hits, "misses": self.misses}
+
+    # --------------------------------------------------------
+    # Internals (caller holds the lock)
+    # --------------------------------------------------------
+
+    def _put(self, thread, post):
+        old = thread.posts.get(post["id"])
+        if old:
+            self._account(thread, -len(old["message"]))
+            thread.posts[post["id"]] = post
+        else:
+            thread.posts[post["id"]] = post
+            if post["create_at"] and any(p["create_at"] > post["create_at"] for p in thread.posts.values()):
+                items = sorted(thread.posts.items(), key=lambda kv: kv[1]["create_at"])
+                thread.posts = collections.OrderedDict(items)
+        self._account(thread, len(post["message"]))
+        while len(thread.posts) > self.max_posts:
+            # Drop the oldest reply but keep the root post for context.
+            ids = iter(thread.posts)
+            next(ids)
+            self._remove(thread, next(ids))
+
+    def _remove(self, thread, post_id):
+        post = thread.posts.pop(post_id)
+        self._account(thread, -len(post["message"]))
+
+    def _drop(self, root_id):
+        thread = self._threads.pop(root_id, None)
+        if thread:
+            self._chars -= thread.chars
+
+    def _account(self, thread, delta):
+        thread.chars += delta
+        self._chars += delta
+
+    def _evict(self):
+        while self._threads and (len(self._threads) > self.max_threads or self._chars > self.max_chars):
+            self._drop(next(iter(self._threads)))
+
+
+def format_history(posts, name_of, limit=20, max_chars=4000):
+    """Render the last `limit` posts as `name: message` lines, newest kept within max_chars."""
+    lines = []
+    total = 0
+    for post in reversed(posts[-limit:]):
+        line = f"{name_of(post['user_id'])}: {post['message']}"
+        total += len(line)
+        if total > max_chars:
+            break
+        lines.append(line)
+    return "\n".join(reversed(lines))
+
+
+def add_arguments(parser):
+    """Register the thread cache flags on an argparse parser."""
+    parser.add_argument("--thread-cache-threads", type=int, default=200,
+                        help="Thread histories kept in memory, LRU (default: 200)")
+    parser.add_argument("--thread-cache-posts", type=int, default=50,
+                        help="Posts kept per cached thread (default: 50)")
+    parser.add_argument("--thread-context-posts", type=int, default=20,
+                        help="Earlier thread posts included in the agent prompt (default: 20)")
+    parser.add_argument("--no-thread-context", action="store_true",
+                        help="Answer thread replies without thread history")
+
+
+def from_args(args):
+    return ThreadCache(max_threads=args.thread_cache_threads, max_posts=args.thread_cache_posts)
@@ -0,0 +1,271 @@
+"""
+Session traces for the Mattermost listeners — JOYA Toolkit
+
+`--trace FILE` records everything a listener sees and decides to a gzipped
+JSON-lines file, so production sessions can be replayed offline with
+mm-replay.py:
+
+    {"k": "hdr",      "t": 0,     "version": 1, "listener": "...", "backend": "openclaw", "cfg": {...}}
+    {"k": "ws",       "t": 1.204, "raw": "<websocket frame>"}
+    {"k": "decision", "t": 1.205, "id": "<post id>", "accept": true}
+    {"k": "rest",     "t": 1.206, "op": "user", "key": "<user id>", "val": "bob", "ms": 31}
+    {"k": "rest",     "t": 1.420, "op": "file", "key": "<file id>", "val": [...], "ms": 212}
+    {"k": "rest",     "t": 1.433, "op": "thread", "key": "<root id>", "val": {...}, "ms": 95}
+    {"k": "backend",  "t": 9.872, "id": "<post id>", "key": "<sha1 of prompt>", "ms": 8450, "out": "..."}
+    {"k": "post",     "t": 9.990, "id": "<post id>", "channel": "<channel id>", "msg": "...", "ms": 118}
+
+Times are seconds since the trace started. Bot and admin tokens are never
+written: outgoing frames (which carry the auth challenge) are not recorded,
+and any occurrence of a configured token is replaced with [REDACTED].
+
+The recorder wraps the listener module's functions in place, so listen()
+itself needs no trace hooks. Writes go through a queue to a background
+thread, like mm_log. The listeners are usually stopped with `kill`, so
+recording also turns SIGTERM into a normal exit that closes the gzip stream;
+read() still accepts a trace cut off mid-write and stops at its last complete
+line.
+"""
+
+import atexit
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+TRACE_VERSION = 1
+REDACTED = "[REDACTED]"
+
+# Backend entry point of the listener core; prompts and replies are recorded.
+BACKEND_FUNCS = ("call_backend",)
+
+
+def prompt_key(text):
+    """Stable key for a backend prompt (the prompt itself can be large)."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def posted_id(raw):
+    """Post id of a `posted` websocket frame, or "" for any other frame."""
+    if '"posted"' not in raw:
+        return ""
+    try:
+        evt = json.loads(raw)
+        post = evt.get("data", {}).get("post", "{}")
+        post = json.loads(post) if isinstance(post, str) else post
+        return post.get("id", "") if evt.get("event") == "posted" else ""
+    except (ValueError, AttributeError):
+        return ""
+
+
+def public_cfg(cfg):
+    """Listener config without credentials, as stored in the trace header."""
+    return {k: v for k, v in cfg.items() if "token" not in k}
+
+
+def read(path):
+    """Yield trace records from a (possibly gzipped, possibly truncated) trace file."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # partial last line of a trace that was cut off
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except EOFError:
+            pass  # gzip stream without its end marker (listener was killed)
+
+
+# ============================================================
+# Recorder
+# ============================================================
+
+class Recorder:
+    """Append trace records from any thread; a writer thread compresses and flushes."""
+
+    def __init__(self, path, secrets=()):
+        self.path = path
+        self.t0 = time.monotonic()
+        self.current_event = ""
+        self.local = threading.local()
+        self._secrets = [s for s in secrets if s]
+        self._q = queue.SimpleQueue()
+        opener = gzip.open if path.endswith(".gz") else open
+        self._f = opener(path, "wt", encoding="utf-8")
+        self._thread = threading.Thread(target=self._writer, name="mm-trace-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, kind, **fields):
+        self._q.put({"k": kind, "t": round(time.monotonic() - self.t0, 4), **fields})
+
+    def handler_event(self):
+        """Post id being handled on this thread (falls back to the last frame's)."""
+        return getattr(self.local, "event_id", "") or self.current_event
+
+    def frame(self, raw):
+        self.write("ws", raw=raw)
+        event_id = posted_id(raw)
+        if event_id:
+            self.current_event = event_id
+
+    def close(self):
+        if self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout=5)
+
+    def _writer(self):
+        while True:
+            try:
+                entry = self._q.get(timeout=1)
+            except queue.Empty:
+                self._f.flush()
+                continue
+            if entry is None:
+                break
+            line = json.dumps(entry, ensure_ascii=False, default=str)
+            for secret in self._secrets:
+                line = line.replace(secret, REDACTED)
+            self._f.write(line + "\n")
+        self._f.close()
+
+
+class _TracingSocket:
+    """Websocket proxy that records every received frame."""
+
+    def __init__(self, ws, rec):
+        self._ws = ws
+        self._rec = rec
+
+    async def send(self, data):
+        # Not recorded: the first frame is the authentication challenge.
+        return await self._ws.send(data)
+
+    async def recv(self):
+        raw = await self._ws.recv()
+        self._rec.frame(raw)
+        return raw
+
+    async def __aiter__(self):
+        async for raw in self._ws:
+            self._rec.frame(raw)
+            yield raw
+
+
+class _TracingConnect:
+    def __init__(self, cm, rec):
+        self._cm = cm
+        self._rec = rec
+
+    async def __aenter__(self):
+        self._rec.write("conn")
+        return _TracingSocket(await self._cm.__aenter__(), self._rec)
+
+    async def __aexit__(self, *exc):
+        return await self._cm.__aexit__(*exc)
+
+
+class _TracingWebsockets:
+    """Stand-in for the `websockets` module whose connect() records frames."""
+
+    def __init__(self, websockets, rec):
+        self._websockets = websockets
+        self._rec = rec
+
+    def connect(self, *args, **kwargs):
+        return _TracingConnect(self._websockets.connect(*args, **kwargs), self._rec)
+
+    def __getattr__(self, name):
+        return getattr(self._websockets, name)
+
+
+def _timed(fn, emit):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t = time.monotonic()
+        result = fn(*args, **kwargs)
+        emit(result, int((time.monotonic() - t) * 1000), *args, **kwargs)
+        return result
+    return wrapper
+
+
+def _exit_on_sigterm(rec):
+    """Make `kill` close the trace: SIGTERM skips atexit handlers by default."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+        return
+
+    def on_sigterm(signum, frame):
+        rec.close()
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def record(module, path, cfg):
+    """Start recording `module` (a loaded listener) to `path`. Returns the Recorder."""
+    rec = Recorder(path, secrets=(cfg.get("my_bot_token"), cfg.get("admin_token")))
+    backend = getattr(module, "BACKEND", None)
+    rec.write("hdr", version=TRACE_VERSION, listener=os.path.basename(module.__file__),
+              backend=backend.name if backend else "", cfg=public_cfg(cfg))
+
+    _exit_on_sigterm(rec)
+    module.websockets = _TracingWebsockets(module.websockets, rec)
+
+    def on_decision(result, ms, message, user_id, *a, **kw):
+        rec.write("decision", id=rec.current_event, accept=bool(result))
+
+    def on_user(result, ms, user_id, *a, **kw):
+        rec.write("rest", op="user", key=user_id, val=result, ms=ms)
+
+    def on_file(result, ms, file_id, *a, **kw):
+        rec.write("rest", op="file", key=file_id, val=list(result) if result else None, ms=ms)
+
+    def on_thread(result, ms, root_id, *a, **kw):
+        rec.write("rest", op="thread", key=root_id, val=result, ms=ms)
+
+    def on_post(result, ms, channel_id, message, *a, **kw):
+        rec.write("post", id=rec.handler_event(), channel=channel_id, msg=message, ms=ms)
+
+    def on_backend(result, ms, message, *a, **kw):
+        rec.write("backend", id=rec.handler_event(), key=prompt_key(message), ms=ms, out=result)
+
+    hooks = {
+        "should_i_respond": on_decision,
+        "get_username": on_user,
+        "download_file": on_file,
+        "fetch_thread": on_thread,
+        "mm_post": on_post,
+    }
+    hooks.update({name: on_backend for name in BACKEND_FUNCS})
+    for name, emit in hooks.items():
+        fn = getattr(module, name, None)
+        if fn:
+            setattr(module, name, _timed(fn, emit))
+
+    handle = getattr(module, "handle_message", None)
+    if handle:
+        sig = inspect.signature(handle)
+
+        @functools.wraps(handle)
+        def traced_handle(*args, **kwargs):
+            rec.local.event_id = sig.bind(*args, **kwargs).arguments.get("event_id", "")
+            try:
+                return handle(*args, **kwargs)
+            finally:
+                rec.local.event_id = ""
+        module.handle_message = traced_handle
+    return rec
+
+
+def add_arguments(parser):
+    parser.add_argument("--trace", default="",
+                        help="Record frames, REST responses and backend timings to this file (.gz to compress)")